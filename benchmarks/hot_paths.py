@@ -0,0 +1,260 @@
+"""Benchmark the XPI, S3 and Balrog hot paths against synthetic data.
+
+XPIs are generated with both `install.rdf` and `manifest.json` at a range
+of sizes, S3 is stood in for by moto (those benchmarks are skipped if it
+is not installed) and Balrog by a local HTTP server. Results can be saved
+and compared with an earlier run:
+
+    $ python benchmarks/hot_paths.py --save hot_paths.json
+    $ python benchmarks/hot_paths.py --compare hot_paths.json
+"""
+import argparse
+import http.server
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reporting import add_arguments, report  # noqa: E402
+
+
+KB = 1024
+MB = 1024 * KB
+
+SIZES = [100 * KB, 1 * MB, 10 * MB, 50 * MB, 200 * MB]
+
+INSTALL_RDF = '''<?xml version="1.0"?>
+<RDF xmlns="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+     xmlns:em="http://www.mozilla.org/2004/em-rdf#">
+  <Description about="urn:mozilla:install-manifest">
+    <em:id>{id}</em:id>
+    <em:version>{version}</em:version>
+  </Description>
+</RDF>
+'''
+
+
+def format_size(size):
+    return '{}KB'.format(size // KB) if size < MB else '{}MB'.format(size // MB)
+
+
+def make_xpi(path, size, manifest, addon_id='bench@mozilla.org', version='1.0'):
+    """Write an XPI of roughly `size` bytes, padded with incompressible data."""
+    with zipfile.ZipFile(path, 'w') as zf:
+        if manifest == 'install.rdf':
+            zf.writestr('install.rdf', INSTALL_RDF.format(id=addon_id, version=version))
+        else:
+            zf.writestr('manifest.json', json.dumps({
+                'applications': {'gecko': {'id': addon_id}},
+                'manifest_version': 2,
+                'name': 'Benchmark',
+                'version': version,
+            }))
+
+        remaining = size
+        index = 0
+        while remaining > 0:
+            chunk = min(remaining, 4 * MB)
+            zf.writestr('data/{}.bin'.format(index), os.urandom(chunk))
+            remaining -= chunk
+            index += 1
+
+
+def measure(func, setup=None, runs=5):
+    timings = []
+    for _ in range(runs):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        func(arg)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def bench_xpis(results, workdir, sizes, runs):
+    from morgoth.xpi import XPI
+
+    for size in sizes:
+        for manifest in ('install.rdf', 'manifest.json'):
+            path = os.path.join(workdir, '{}-{}.xpi'.format(manifest, size))
+            make_xpi(path, size, manifest)
+            label = '{} {}'.format(manifest, format_size(size))
+
+            results['XPI parse ' + label] = measure(lambda _: XPI(path), runs=runs)
+
+        results['XPI sha512sum ' + format_size(size)] = measure(
+            lambda xpi: xpi.sha512sum, setup=lambda: XPI(path), runs=runs)
+
+        xpi = XPI(path)
+        xpi.sha512sum
+        results['XPI generate_release_data ' + format_size(size)] = measure(
+            lambda _: xpi.generate_release_data(
+                base_url='https://ftp.mozilla.org/', prefix='pub/system-addons/'),
+            runs=runs)
+
+
+def bench_suffixes(results, workdir, key_count, runs):
+    try:
+        import boto3
+        from moto import mock_aws
+    except ImportError:
+        print('moto is not installed, skipping the S3 benchmarks')
+        return
+
+    from morgoth.s3 import BucketListing, find_uploaded_suffix
+    from morgoth.utils import get_upload_metadata
+    from morgoth.xpi import XPI
+
+    prefix = 'pub/system-addons/'
+    path = os.path.join(workdir, 'suffixes.xpi')
+    make_xpi(path, 100 * KB, 'manifest.json')
+    xpi = XPI(path)
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    with mock_aws():
+        bucket = boto3.Session(region_name='us-east-1').resource('s3').Bucket('benchmark')
+        bucket.create()
+
+        # Thousands of other versions of the add-on, plus a few earlier
+        # uploads of this version with different contents
+        for index in range(key_count):
+            bucket.put_object(
+                Key='{}{}/{}-{}.{}-signed.xpi'.format(
+                    prefix, xpi.short_name, xpi.name, index // 100, index % 100),
+                Body=b'')
+        for suffix in ('', '-2', '-3'):
+            bucket.put_object(Key=xpi.get_ftp_path(prefix, suffix=suffix), Body=b'other')
+        with open(path, 'rb') as data:
+            bucket.put_object(
+                Key=xpi.get_ftp_path(prefix, suffix='-4'), Body=data,
+                Metadata=get_upload_metadata(xpi))
+
+        def resolve(_):
+            listing = BucketListing(bucket, os.path.join(prefix, xpi.short_name, ''))
+            if find_uploaded_suffix(xpi, bucket, listing, prefix) != '-4':
+                raise AssertionError('Suffix resolution found the wrong upload')
+            listing.get_free_suffix(xpi, prefix)
+
+        results['S3 suffix resolution {} keys'.format(key_count)] = measure(resolve, runs=runs)
+
+
+class BalrogStub(http.server.BaseHTTPRequestHandler):
+    """Just enough of the Balrog admin API for `modify rules`."""
+    releases = {}
+    release_list = b''
+    rules = {}
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = data if isinstance(data, bytes) else json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/api/users/current':
+            self.send_json({'username': 'benchmark'})
+        elif path == '/api/releases':
+            self.send_json(self.release_list)
+        elif re.match(r'/api/rules/\d+$', path):
+            self.send_json(self.rules[path.rsplit('/', 1)[1]])
+        elif path.startswith('/api/releases/'):
+            self.send_json(self.releases[path.rsplit('/', 1)[1]])
+        else:
+            self.send_json({}, status=404)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.path == '/api/releases':
+            self.releases[body['name']] = json.loads(body['blob'])
+        self.send_json({})
+
+
+def bench_modify_rules(results, release_count, rule_count, runs):
+    from click.testing import CliRunner
+
+    from morgoth import cli as morgoth_cli
+    from morgoth.settings import settings
+
+    mappings = ['Superblob-{}'.format(index) for index in range(20)]
+    BalrogStub.releases = {
+        name: {'blobs': ['addon-{}'.format(index)], 'name': name, 'schema_version': 4000}
+        for index, name in enumerate(mappings)
+    }
+    BalrogStub.release_list = json.dumps({'releases': [
+        {'name': 'addon-{}'.format(index), 'product': 'SystemAddons'}
+        for index in range(release_count)
+    ] + [{'name': name, 'product': 'SystemAddons'} for name in mappings]}).encode()
+    BalrogStub.rules = {
+        str(rule_id): {
+            'channel': 'release-sysaddon',
+            'mapping': mappings[rule_id % len(mappings)],
+            'rule_id': rule_id,
+            'version': '60.0',
+        }
+        for rule_id in range(rule_count)
+    }
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), BalrogStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    settings.set('balrog_url', 'http://127.0.0.1:{}/'.format(server.server_port))
+    settings.set('bearer_token', 'benchmark')
+
+    rule_ids = sorted(BalrogStub.rules, key=int)
+    answers = 'y\naddon-1\nn\nn\n' + 'y\n' * rule_count
+
+    def modify(_):
+        result = CliRunner().invoke(
+            morgoth_cli.cli, ['modify', 'rules'] + rule_ids, input=answers)
+        if result.exit_code != 0:
+            raise AssertionError(result.output)
+
+    try:
+        results['modify rules {} releases {} rules'.format(release_count, rule_count)] = measure(
+            modify, runs=runs)
+    finally:
+        server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument(
+        '--max-size', type=int, default=200, metavar='MB',
+        help='Skip XPIs bigger than this many megabytes.')
+    parser.add_argument('--keys', type=int, default=5000)
+    parser.add_argument('--releases', type=int, default=10000)
+    parser.add_argument('--rules', type=int, default=300)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    sizes = [size for size in SIZES if size <= args.max_size * MB]
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        # Keep the benchmarks away from the real config and caches. This
+        # has to happen before morgoth is first imported.
+        os.environ['HOME'] = workdir
+
+        bench_xpis(results, workdir, sizes, args.runs)
+        bench_suffixes(results, workdir, args.keys, args.runs)
+        bench_modify_rules(results, args.releases, args.rules, args.runs)
+
+    report(results, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Saving, comparing and printing benchmark results."""
+import json
+import platform
+import subprocess
+import sys
+import time
+
+
+def get_git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], check=True, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def add_arguments(parser):
+    parser.add_argument('--save', metavar='PATH', help='Save the results as JSON.')
+    parser.add_argument('--compare', metavar='PATH', help='Compare with saved results.')
+    parser.add_argument(
+        '--threshold', type=float, default=1.25,
+        help='Fail if a benchmark is this many times slower than the saved results.')
+
+
+def load_results(path):
+    with open(path, 'r') as f:
+        data = json.load(f)
+    # Older result files are a bare mapping of names to seconds
+    return data['results'] if isinstance(data.get('results'), dict) else data
+
+
+def report(results, args):
+    """Print results in seconds, save them and compare them as requested.
+
+    Exits with an error if anything regressed past the threshold.
+    """
+    previous = load_results(args.compare) if args.compare else {}
+
+    regressions = []
+    for name, seconds in results.items():
+        line = '{:<44} {:10.2f} ms'.format(name, seconds * 1000)
+        if name in previous:
+            ratio = seconds / previous[name]
+            line += '  ({:+.0%})'.format(ratio - 1)
+            if ratio > args.threshold:
+                regressions.append(name)
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'timestamp': time.time(),
+                'revision': get_git_revision(),
+                'python': platform.python_version(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if regressions:
+        print('Slower than {}: {}'.format(args.compare, ', '.join(regressions)))
+        sys.exit(1)
@@ -0,0 +1,74 @@
+"""Measure how long `morgoth` takes to start for each subcommand.
+
+Each command is run in a fresh interpreter several times and the median
+wall time is reported. Results can be saved and compared with an
+earlier run to catch regressions:
+
+    $ python benchmarks/startup.py --save startup.json
+    $ python benchmarks/startup.py --compare startup.json
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from reporting import add_arguments, report
+
+
+COMMANDS = [
+    ['--help'],
+    ['config', '-l'],
+    ['status'],
+    ['make', '--help'],
+    ['make', 'release', '--help'],
+    ['make', 'releases', '--help'],
+    ['make', 'superblob', '--help'],
+    ['modify', 'rules', '--help'],
+    ['promote', 'rules', '--help'],
+    ['plan', 'rules', '--help'],
+    ['apply', '--help'],
+    ['sync', '--help'],
+    ['find', '--help'],
+    ['rules', '--help'],
+    ['verify', '--help'],
+    ['shell', '--help'],
+    ['snapshot', 'save', '--help'],
+]
+
+ENTRY_POINT = 'from morgoth.cli import cli; cli(prog_name="morgoth")'
+
+
+def time_command(args, runs, env):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, '-c', ENTRY_POINT] + args, env=env, check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as home:
+        # Run against an empty home directory so local config doesn't skew results
+        env = dict(os.environ, HOME=home, PYTHONPATH=root)
+        results = {}
+        for command in COMMANDS:
+            name = ' '.join(command)
+            results[name] = time_command(command, args.runs, env)
+
+    report(results, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ import os
 
 HOME_DIR = os.path.expanduser('~')
 CONFIG_PATH = os.path.join(HOME_DIR, '.morgoth_config')
+CACHE_DIR = os.path.join(HOME_DIR, '.morgoth_cache')
 
 STATUS_5H17 = base64.b64decode(
     b'CiAgICAgKCAgICkKICAoICAgKSAoCiAgICkgXyAgICkKIC'
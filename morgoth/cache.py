@@ -0,0 +1,326 @@
+import base64
+import json
+import os
+import sqlite3
+import time
+
+from contextlib import contextmanager
+from hashlib import sha256
+
+import requests
+
+from requests.structures import CaseInsensitiveDict
+
+from morgoth import CACHE_DIR
+from morgoth.hashing import Digest
+
+
+HTTP_CACHE_DIR = os.path.join(CACHE_DIR, 'http')
+CREDENTIALS_CACHE_PATH = os.path.join(CACHE_DIR, 'credentials.json')
+XPI_CACHE_PATH = os.path.join(CACHE_DIR, 'xpis.sqlite')
+DEFAULT_CACHE_SIZE = 50 * 1024 * 1024
+DEFAULT_XPI_CACHE_ENTRIES = 1000
+
+# Treat tokens as expired a little early so they don't lapse mid-command
+EXPIRY_MARGIN = 60
+
+
+def get_token_identity(bearer_token):
+    return sha256((bearer_token or '').encode()).hexdigest()[:16]
+
+
+def get_token_expiry(bearer_token):
+    """Return the `exp` claim of a JWT bearer token, or None.
+
+    The signature is not checked, the server does that when we validate.
+    """
+    try:
+        payload = bearer_token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload.encode()).decode())
+        return int(claims['exp'])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class ResponseCache(object):
+    """An on-disk cache of GET responses that are revalidated before use.
+
+    Entries are keyed by URL and a hash of the bearer token, and are
+    stored as a metadata file next to the raw body. The cache is trimmed
+    back to `max_size` bytes by evicting the least recently used entries.
+    """
+
+    def __init__(self, path=HTTP_CACHE_DIR, max_size=DEFAULT_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    def _get_key(self, url, bearer_token):
+        return sha256('{}:{}'.format(get_token_identity(bearer_token), url).encode()).hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.path, key)
+        return '{}.json'.format(base), '{}.body'.format(base)
+
+    def get(self, url, bearer_token):
+        meta_path, body_path = self._paths(self._get_key(url, bearer_token))
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            with open(body_path, 'rb') as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+
+        # Bump the access time so eviction is least recently used first
+        os.utime(meta_path)
+        return CacheEntry(meta, body)
+
+    def put(self, url, bearer_token, endpoint, response, body=None):
+        """Store a response, with `body` standing in for a streamed response's content."""
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return
+
+        key = self._get_key(url, bearer_token)
+        meta_path, body_path = self._paths(key)
+        meta = {
+            'url': url,
+            'endpoint': endpoint,
+            'etag': etag,
+            'last_modified': last_modified,
+            'headers': {'Content-Type': response.headers.get('Content-Type', '')},
+            'encoding': response.encoding,
+        }
+
+        os.makedirs(self.path, exist_ok=True)
+        suffix = '.{}.tmp'.format(os.getpid())
+        with open(body_path + suffix, 'wb') as f:
+            f.write(response.content if body is None else body)
+        with open(meta_path + suffix, 'w') as f:
+            json.dump(meta, f)
+        os.replace(body_path + suffix, body_path)
+        os.replace(meta_path + suffix, meta_path)
+
+        self.prune()
+
+    def _entries(self):
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        return [name[:-5] for name in names if name.endswith('.json')]
+
+    def _remove(self, key):
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def invalidate(self, endpoint):
+        """Drop every entry under the collections touched by a write to `endpoint`.
+
+        A scheduled change to a rule invalidates both `scheduled_changes`
+        and `rules`, for example.
+        """
+        collections = set(endpoint.split('?')[0].strip('/').split('/'))
+        for key in self._entries():
+            meta_path, _ = self._paths(key)
+            try:
+                with open(meta_path, 'r') as f:
+                    cached_endpoint = json.load(f).get('endpoint', '')
+            except (OSError, ValueError):
+                continue
+            if cached_endpoint.split('?')[0].strip('/').split('/')[0] in collections:
+                self._remove(key)
+
+    def clear(self):
+        for key in self._entries():
+            self._remove(key)
+
+    def prune(self):
+        entries = []
+        total_size = 0
+        for key in self._entries():
+            meta_path, body_path = self._paths(key)
+            try:
+                accessed = os.path.getmtime(meta_path)
+                size = os.path.getsize(meta_path) + os.path.getsize(body_path)
+            except OSError:
+                continue
+            entries.append((accessed, size, key))
+            total_size += size
+
+        for accessed, size, key in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            self._remove(key)
+            total_size -= size
+
+
+class CacheEntry(object):
+
+    def __init__(self, meta, body):
+        self.meta = meta
+        self.body = body
+
+    @property
+    def validation_headers(self):
+        headers = {}
+        if self.meta.get('etag'):
+            headers['If-None-Match'] = self.meta['etag']
+        if self.meta.get('last_modified'):
+            headers['If-Modified-Since'] = self.meta['last_modified']
+        return headers
+
+    def to_response(self, request=None):
+        response = requests.Response()
+        response.status_code = 200
+        response.url = self.meta['url']
+        response.headers = CaseInsensitiveDict(self.meta.get('headers', {}))
+        response.encoding = self.meta.get('encoding')
+        response.request = request
+        response._content = self.body
+        response._content_consumed = True
+        return response
+
+
+class CredentialCache(object):
+    """Remembers which bearer tokens a Balrog server accepted, until they expire.
+
+    Only hashes of the tokens are stored. Tokens without an expiry are
+    never cached.
+    """
+
+    def __init__(self, path=CREDENTIALS_CACHE_PATH):
+        self.path = path
+
+    def _key(self, url, bearer_token):
+        return '{}:{}'.format(get_token_identity(bearer_token), url)
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def is_valid(self, url, bearer_token):
+        expiry = self._load().get(self._key(url, bearer_token))
+        return expiry is not None and expiry - EXPIRY_MARGIN > time.time()
+
+    def add(self, url, bearer_token):
+        expiry = get_token_expiry(bearer_token)
+        if expiry is None:
+            return
+
+        now = time.time()
+        entries = {key: exp for key, exp in self._load().items() if exp > now}
+        entries[self._key(url, bearer_token)] = expiry
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+
+class XPICache(object):
+    """An index of local XPI files to their metadata, hashes and S3 uploads.
+
+    Files are identified by their real path, size, modification time and
+    inode, so any change to a file misses the cache. Only the
+    `max_entries` most recently used files are kept.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS xpis (
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            version TEXT NOT NULL,
+            digests TEXT,
+            accessed REAL NOT NULL,
+            PRIMARY KEY (path, size, mtime_ns, inode)
+        );
+        CREATE TABLE IF NOT EXISTS uploads (
+            sha512 TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            key TEXT NOT NULL,
+            PRIMARY KEY (sha512, bucket, key)
+        );
+    """
+
+    def __init__(self, path=XPI_CACHE_PATH, max_entries=DEFAULT_XPI_CACHE_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._initialized = False
+
+    @contextmanager
+    def _connect(self):
+        # A connection per call keeps the cache safe to share between
+        # threads and processes
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=10)
+        try:
+            if not self._initialized:
+                connection.executescript(self.SCHEMA)
+                self._initialized = True
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def get_file_key(path):
+        stat = os.stat(path)
+        return os.path.realpath(path), stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def get(self, file_key):
+        """Return the name, version and digest (or None) cached for a file."""
+        with self._connect() as connection:
+            row = connection.execute(
+                'SELECT name, version, digests FROM xpis '
+                'WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?', file_key).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                'UPDATE xpis SET accessed = ? '
+                'WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?',
+                (time.time(),) + file_key)
+
+        name, version, digests = row
+        digest = None
+        if digests:
+            digest = Digest.from_hexdigests(json.loads(digests), file_key[1])
+        return name, version, digest
+
+    def put(self, file_key, name, version, digest=None):
+        digests = json.dumps(digest.hexdigests) if digest else None
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO xpis '
+                '(path, size, mtime_ns, inode, name, version, digests, accessed) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                file_key + (name, version, digests, time.time()))
+            connection.execute(
+                'DELETE FROM xpis WHERE rowid NOT IN '
+                '(SELECT rowid FROM xpis ORDER BY accessed DESC LIMIT ?)', (self.max_entries,))
+
+    def get_uploads(self, sha512, bucket_name):
+        with self._connect() as connection:
+            rows = connection.execute(
+                'SELECT key FROM uploads WHERE sha512 = ? AND bucket = ?',
+                (sha512, bucket_name)).fetchall()
+        return {row[0] for row in rows}
+
+    def add_upload(self, sha512, bucket_name, key):
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR IGNORE INTO uploads (sha512, bucket, key) VALUES (?, ?, ?)',
+                (sha512, bucket_name, key))
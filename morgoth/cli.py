@@ -1,35 +1,97 @@
+import atexit
+import glob
 import os
 import json
+import time
 
 from datetime import datetime
-from hashlib import sha256
 
-import boto3
 import click
 
 from colorama import Fore, Style
-from requests.exceptions import HTTPError, Timeout
 
 from morgoth import CONFIG_PATH, STATUS_5H17
-from morgoth.environment import Environment
+from morgoth.hashing import CHUNK_SIZE
 from morgoth.settings import settings
-from morgoth.utils import output, validate_uploaded_xpi_hash
-from morgoth.xpi import XPI
+from morgoth.timings import instrument_boto3_session, timings
+from morgoth.utils import (
+    get_modified_superblobs, get_superblob_blobs, get_superblob_data, get_upload_metadata,
+    iter_json_array, output, read_release_name)
 
 
+# boto3, requests and the modules built on them are slow to import, so
+# they are imported by the commands that need them to keep startup fast.
+
 DEFAULT_BALROG_URL = 'https://aus4-admin.mozilla.org/'
 DEFAULT_AWS_BASE_URL = 'https://ftp.mozilla.org/'
 DEFAULT_AWS_BUCKET_NAME = 'net-mozaws-prod-delivery-archive'
 DEFAULT_AWS_PREFIX = 'pub/system-addons/'
+DEFAULT_RELEASE_GLOB = '*.json'
+DEFAULT_SCHEDULE_RATE = 5
+DEFAULT_WAIT_TIMEOUT = 600
+WAIT_INITIAL_DELAY = 1
+WAIT_MAX_DELAY = 30
+
+# Set by `morgoth shell` so objects and responses outlive a single command
+session_cache = None
+
+
+def get_transport_settings():
+    from morgoth.environment import (
+        DEFAULT_BACKOFF_FACTOR, DEFAULT_CONNECT_TIMEOUT, DEFAULT_MAX_RETRIES, DEFAULT_POOL_SIZE,
+        DEFAULT_READ_TIMEOUT)
+
+    return {
+        'pool_size': int(settings.get('http.pool_size', DEFAULT_POOL_SIZE)),
+        'connect_timeout': float(settings.get('http.connect_timeout', DEFAULT_CONNECT_TIMEOUT)),
+        'read_timeout': float(settings.get('http.read_timeout', DEFAULT_READ_TIMEOUT)),
+        'max_retries': int(settings.get('http.max_retries', DEFAULT_MAX_RETRIES)),
+        'backoff_factor': float(settings.get('http.backoff_factor', DEFAULT_BACKOFF_FACTOR)),
+        'cache': get_response_cache(),
+    }
+
+
+def get_response_cache():
+    from morgoth.cache import DEFAULT_CACHE_SIZE, ResponseCache
+
+    if settings.get('http.cache', '').lower() not in ('1', 'true', 'yes', 'on'):
+        return None
+    return ResponseCache(max_size=int(settings.get('http.cache_size', DEFAULT_CACHE_SIZE)))
 
 
 def get_validated_environment(**kwargs):
+    if session_cache is None or kwargs.get('force'):
+        return _get_validated_environment(**kwargs)
+
+    def create_environment():
+        environment = _get_validated_environment(**kwargs)
+        environment.write_listeners.append(session_cache.on_write)
+        return environment
+
+    key = (
+        kwargs.get('url', settings.get('balrog_url', DEFAULT_BALROG_URL)),
+        kwargs.get('bearer_token', settings.get('bearer_token')))
+    return session_cache.get('environments', key, create_environment)
+
+
+def _get_validated_environment(**kwargs):
+    from requests.exceptions import HTTPError, Timeout
+
+    from morgoth.cache import CredentialCache
+    from morgoth.environment import Environment
+
     environment = Environment(
         kwargs.get('url', settings.get('balrog_url', DEFAULT_BALROG_URL)),
-        bearer_token=kwargs.get('bearer_token', settings.get('bearer_token')))
+        bearer_token=kwargs.get('bearer_token', settings.get('bearer_token')),
+        **get_transport_settings())
+
+    credentials = CredentialCache()
+    if not kwargs.get('force') and credentials.is_valid(environment.url, environment.bearer_token):
+        return environment
 
     try:
-        environment.validate()
+        with timings.phase('validate credentials'):
+            environment.validate()
     except Timeout:
         output('Timeout while attempting to connect. Check VPN.', Fore.RED)
         exit(1)
@@ -42,12 +104,216 @@ def get_validated_environment(**kwargs):
             exit(1)
         raise
 
+    credentials.add(environment.url, environment.bearer_token)
+
     return environment
 
 
+def get_environment(snapshot_path=None, **kwargs):
+    """Return a validated environment, or a read-only one backed by a snapshot."""
+    if snapshot_path is None:
+        return get_validated_environment(**kwargs)
+
+    from morgoth.snapshot import Snapshot, SnapshotEnvironment, SnapshotError
+
+    try:
+        with timings.phase('load snapshot'):
+            snapshot = Snapshot.load(snapshot_path)
+    except SnapshotError as err:
+        output(str(err), Fore.RED)
+        exit(1)
+
+    created = datetime.fromtimestamp(snapshot.created).strftime('%Y-%m-%d %H:%M')
+    output(f'Using a snapshot of {snapshot.balrog_url} from {created}.', Fore.BLUE)
+    return SnapshotEnvironment(snapshot)
+
+
+def uses_session_cache(environment):
+    # Snapshots are already in memory and must never mix with live data
+    return session_cache is not None and not hasattr(environment, 'snapshot')
+
+
+def save_superblob(sb_data):
+    sb_path = 'releases/superblobs/{}.json'.format(sb_data['name'])
+    os.makedirs('releases/superblobs', exist_ok=True)
+    with open(sb_path, 'w') as f:
+        f.write(json.dumps(sb_data, indent=2, sort_keys=True))
+    return sb_path
+
+
+def prefetch_rules(environment, rule_ids, mappings=False):
+    """Fetch the given rules, and optionally their mapped releases, concurrently."""
+    import asyncio
+
+    from morgoth.environment import AsyncEnvironment
+
+    with AsyncEnvironment(environment, concurrency=environment.pool_size) as async_environment:
+        if not uses_session_cache(environment):
+            return asyncio.run(async_environment.fetch_rules(rule_ids, mappings=mappings))
+
+        def fetch_rules(missing):
+            rules, _ = asyncio.run(async_environment.fetch_rules(
+                [rule_id for url, rule_id in missing]))
+            return {(environment.url, rule_id): rule for rule_id, rule in rules.items()}
+
+        def fetch_releases(missing):
+            releases = asyncio.run(async_environment.fetch_releases(
+                [name for url, name in missing]))
+            return {(environment.url, name): release for name, release in releases.items()}
+
+        rules = session_cache.get_many(
+            'rules', [(environment.url, rule_id) for rule_id in rule_ids], fetch_rules)
+
+        releases = {}
+        if mappings:
+            releases = session_cache.get_many(
+                'releases', [(environment.url, rule['mapping']) for rule in rules.values()],
+                fetch_releases)
+
+    return (
+        {rule_id: rule for (url, rule_id), rule in rules.items()},
+        {name: release for (url, name), release in releases.items()})
+
+
+def request_concurrently(environment, calls, rate_limiter=None):
+    """Make `(endpoint, data)` requests concurrently.
+
+    Returns the response or the exception raised for each call, in order.
+    """
+    import asyncio
+
+    from morgoth.environment import AsyncEnvironment
+
+    async def run(async_environment):
+        return await asyncio.gather(*[
+            async_environment.request(endpoint, data=data) for endpoint, data in calls
+        ], return_exceptions=True)
+
+    with AsyncEnvironment(environment, concurrency=environment.pool_size,
+                          rate_limiter=rate_limiter) as async_environment:
+        return asyncio.run(run(async_environment))
+
+
+def wait_for_scheduled_changes(environment, sc_ids, timeout=DEFAULT_WAIT_TIMEOUT):
+    """Poll Balrog until the given scheduled rule changes are enacted.
+
+    Returns the ids of the changes that were not enacted, either because
+    they were still pending when `timeout` ran out or because they were
+    deleted or cancelled.
+    """
+    pending = set(sc_ids)
+    cancelled = set()
+    deadline = time.monotonic() + timeout
+    delay = WAIT_INITIAL_DELAY
+    while pending:
+        response = environment.request('scheduled_changes/rules', params={'all': 1})
+        changes = {
+            change.get('sc_id'): change
+            for change in response.json().get('scheduled_changes', [])
+        }
+        # Enacted changes stay in the list marked complete, so any that have
+        # dropped out of it were deleted or cancelled
+        cancelled.update(sc_id for sc_id in pending if sc_id not in changes)
+        pending = {
+            sc_id for sc_id in pending
+            if sc_id in changes and not changes[sc_id].get('complete')
+        }
+        if not pending or time.monotonic() + delay > deadline:
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, WAIT_MAX_DELAY)
+    return pending | cancelled
+
+
+def get_release_names(environment, product='SystemAddons'):
+    """Return the set of release names for a product.
+
+    The releases list is parsed as it streams in, keeping only the names.
+    Servers that ignore the product filter still give the right answer.
+    """
+    def fetch_release_names():
+        response = environment.request('releases', params={'product': product}, stream=True)
+        return frozenset(
+            release.get('name')
+            for release in iter_json_array(response.iter_content(CHUNK_SIZE), 'releases')
+            if release.get('product') == product)
+
+    if not uses_session_cache(environment):
+        return set(fetch_release_names())
+    return set(session_cache.get('release names', (environment.url, product), fetch_release_names))
+
+
+def get_boto3_session(profile=None):
+    """Return an instrumented boto3 session, kept for the session in a shell."""
+    import boto3
+
+    def create_session():
+        session = boto3.Session(profile_name=profile or settings.get('aws.profile'))
+        instrument_boto3_session(session)
+        return session
+
+    if session_cache is None:
+        return create_session()
+    return session_cache.get('boto3 sessions', profile or settings.get('aws.profile'),
+                             create_session)
+
+
+def get_bucket_listing(bucket, prefix, ttl=0):
+    """Return a listing of part of a bucket, kept for the session in a shell.
+
+    Listings stay accurate because our own uploads are added to them.
+    """
+    from morgoth.s3 import BucketListing
+
+    if session_cache is None:
+        return BucketListing(bucket, prefix, ttl=ttl)
+    return session_cache.get(
+        'S3 listings', (bucket.name, prefix), lambda: BucketListing(bucket, prefix, ttl=ttl))
+
+
+def get_xpi_cache():
+    from morgoth.cache import DEFAULT_XPI_CACHE_ENTRIES, XPICache
+
+    if settings.get('xpi.cache', 'true').lower() in ('0', 'false', 'no', 'off'):
+        return None
+    return XPICache(max_entries=int(settings.get('xpi.cache_entries', DEFAULT_XPI_CACHE_ENTRIES)))
+
+
+def get_known_uploads(xpi_cache, xpi, bucket):
+    if not xpi_cache:
+        return set()
+    return xpi_cache.get_uploads(xpi.sha512sum, bucket.name)
+
+
+def get_transfer_settings():
+    from morgoth.s3 import (
+        DEFAULT_MAX_CONCURRENCY, DEFAULT_MULTIPART_CHUNKSIZE, DEFAULT_MULTIPART_THRESHOLD)
+
+    return {
+        'multipart_threshold': int(
+            settings.get('aws.multipart_threshold', DEFAULT_MULTIPART_THRESHOLD)),
+        'multipart_chunksize': int(
+            settings.get('aws.multipart_chunksize', DEFAULT_MULTIPART_CHUNKSIZE)),
+        'max_concurrency': int(settings.get('aws.max_concurrency', DEFAULT_MAX_CONCURRENCY)),
+    }
+
+
+def report_timings(json_path=None):
+    output('')
+    output(timings.format_table(), Style.BRIGHT)
+    if json_path:
+        with open(json_path, 'w') as f:
+            f.write(json.dumps(timings.to_dict(), indent=2, sort_keys=True))
+
+
 @click.group()
-def cli():
-    pass
+@click.option('--timings', 'show_timings', is_flag=True)
+@click.option('--timings-json', type=click.Path(dir_okay=False), default=None)
+def cli(show_timings, timings_json):
+    if (show_timings or timings_json) and not timings.enabled:
+        timings.enabled = True
+        # Commands exit early on errors, so report from an exit handler
+        atexit.register(report_timings, json_path=timings_json)
 
 
 @cli.command()
@@ -72,7 +338,7 @@ def auth(ctx, bearer, verbose):
         bearer = click.prompt('Bearer Token')
 
     output('Attempting to validate Balrog credentials...', Fore.BLUE)
-    get_validated_environment(bearer_token=bearer, verbose=verbose)
+    get_validated_environment(bearer_token=bearer, verbose=verbose, force=True)
 
     ctx.invoke(config, key='bearer_token', value=bearer)
 
@@ -121,16 +387,26 @@ def make():
 
 @make.command('release')
 @click.option('--bearer', '-b', default=None)
-@click.option('--profile', default=settings.get('aws.profile'))
+@click.option('--profile', default=None)
 @click.option('--verbose', '-v', is_flag=True)
 @click.option('--reupload', is_flag=True)
+@click.option('--validate', is_flag=True)
 @click.argument('xpi_file')
-def make_release(xpi_file, bearer, profile, verbose, reupload):
+def make_release(xpi_file, bearer, profile, verbose, reupload, validate):
     """Make a new release from an XPI file."""
+    from requests.exceptions import HTTPError
+
+    from morgoth.s3 import find_uploaded_suffix, upload_file
+    from morgoth.xpi import XPI
+
     prefix = settings.get('aws.prefix', DEFAULT_AWS_PREFIX)
+    xpi_cache = get_xpi_cache()
 
     try:
-        xpi = XPI(xpi_file)
+        with timings.phase('read XPI'):
+            xpi = XPI(xpi_file, cache=xpi_cache)
+            if validate:
+                xpi.validate()
     except XPI.DoesNotExist:
         output('File does not exist.', Fore.RED)
         exit(1)
@@ -147,52 +423,62 @@ def make_release(xpi_file, bearer, profile, verbose, reupload):
             output('Release could not be auto-generated.', Fore.RED)
             exit(1)
 
+        with timings.phase('hash XPI'):
+            xpi.digest
+
         if not xpi.archived:
-            session = boto3.Session(profile_name=profile)
+            session = get_boto3_session(profile)
             s3 = session.resource('s3')
             bucket = s3.Bucket(settings.get('aws.bucket_name', DEFAULT_AWS_BUCKET_NAME))
 
-            existing_files = []
-            for obj in bucket.objects.filter(Prefix=prefix):
-                existing_files.append(obj.key)
+            listing = get_bucket_listing(
+                bucket, os.path.join(prefix, xpi.short_name, ''),
+                ttl=int(settings.get('aws.listing_cache_ttl', 0)))
 
             suffix = ''
             upload_path = xpi.get_ftp_path(prefix)
-            exists = upload_path in existing_files
-
-            uploaded = False
-            if exists:
-                if validate_uploaded_xpi_hash(xpi, bucket, upload_path):
-                    uploaded = True
-                else:
-                    index = 2
-                    check_path = xpi.get_ftp_path(prefix, suffix='-{}'.format(index))
-                    while check_path in existing_files:
-                        if validate_uploaded_xpi_hash(xpi, bucket, check_path):
-                            uploaded = True
-                            suffix = '-{}'.format(index)
-                            break
-                        index += 1
-                        check_path = xpi.get_ftp_path(prefix, suffix='-{}'.format(index))
-
-                if uploaded:
-                    output(
-                        'XPI already uploaded: {}'.format(xpi.get_ftp_path(prefix, suffix=suffix)),
-                        Fore.GREEN)
+            with timings.phase('S3 listing'):
+                listing.keys
+
+            known_keys = get_known_uploads(xpi_cache, xpi, bucket)
+            with timings.phase('S3 hash checks'):
+                uploaded_suffix = find_uploaded_suffix(
+                    xpi, bucket, listing, prefix, known_keys=known_keys)
+            if uploaded_suffix is None:
+                # A file is about to be written, so don't trust a cached listing
+                with timings.phase('S3 listing'):
+                    refreshed = listing.refresh()
+                if refreshed:
+                    with timings.phase('S3 hash checks'):
+                        uploaded_suffix = find_uploaded_suffix(
+                            xpi, bucket, listing, prefix, known_keys=known_keys)
+            exists = upload_path in listing
+            uploaded = uploaded_suffix is not None
+            if uploaded:
+                suffix = uploaded_suffix
+                if xpi_cache:
+                    xpi_cache.add_upload(
+                        xpi.sha512sum, bucket.name, xpi.get_ftp_path(prefix, suffix=suffix))
+                output(
+                    'XPI already uploaded: {}'.format(xpi.get_ftp_path(prefix, suffix=suffix)),
+                    Fore.GREEN)
 
             if not uploaded or reupload:
                 if exists:
                     output('XPI with matching filename already uploaded.', Fore.YELLOW)
                     if not click.confirm('Would you like to replace it?'):
-                        index = 2
-                        upload_path = xpi.get_ftp_path(prefix, suffix='-{}'.format(index))
-                        while upload_path in existing_files:
-                            index += 1
-                            suffix = '-{}'.format(index)
-                            upload_path = xpi.get_ftp_path(prefix, suffix=suffix)
-                with open(xpi.path, 'rb') as data:
-                    bucket.put_object(Key=upload_path, Body=data)
-                    output('XPI uploaded to: {}'.format(upload_path), Fore.GREEN)
+                        suffix = listing.get_free_suffix(xpi, prefix)
+                        upload_path = xpi.get_ftp_path(prefix, suffix=suffix)
+                with timings.phase('S3 upload'):
+                    with click.progressbar(length=xpi.file_size, label='Uploading XPI') as bar:
+                        upload_file(
+                            bucket, upload_path, xpi.path, xpi.sha512sum,
+                            metadata=get_upload_metadata(xpi), progress=bar.update,
+                            **get_transfer_settings())
+                listing.add(upload_path)
+                if xpi_cache:
+                    xpi_cache.add_upload(xpi.sha512sum, bucket.name, upload_path)
+                output('XPI uploaded to: {}'.format(upload_path), Fore.GREEN)
             release_data = xpi.generate_release_data(
                 base_url=settings.get('aws.base_url', DEFAULT_AWS_BASE_URL), prefix=prefix, suffix=suffix)
         else:
@@ -206,20 +492,14 @@ def make_release(xpi_file, bearer, profile, verbose, reupload):
             environment = get_validated_environment(verbose=verbose, **extra_kw)
 
             try:
-                environment.request('releases', data={
-                    'blob': json.dumps(release_data),
-                    'name': '{}{}'.format(xpi.release_name, suffix),
-                    'product': 'SystemAddons',
-                })
+                with timings.phase('Balrog upload'):
+                    environment.request('releases', data={
+                        'blob': json.dumps(release_data),
+                        'name': '{}{}'.format(xpi.release_name, suffix),
+                        'product': 'SystemAddons',
+                    })
             except HTTPError as err:
-                output(f'An error occured: HTTP {err.response.status_code}', Fore.RED)
-                if verbose:
-                    output('Request headers:')
-                    output(json.dumps(dict(err.request.headers), indent=2))
-                    output('Request body:')
-                    output(json.dumps(json.loads(err.request.body.decode()), indent=2))
-                    output('Error from server:')
-                    output(json.dumps(err.response.json(), indent=2))
+                output_http_error(err, verbose)
                 exit(1)
 
             output('Uploaded: {}{}{}'.format(Style.BRIGHT, xpi.release_name, suffix))
@@ -243,66 +523,381 @@ def make_release(xpi_file, bearer, profile, verbose, reupload):
     output('')
 
 
+def load_xpi(path):
+    """Parse and hash an XPI, returning it or an error message."""
+    from morgoth.xpi import XPI
+
+    try:
+        xpi = XPI(path, cache=get_xpi_cache())
+        xpi.digest
+    except XPI.DoesNotExist:
+        return None, 'File does not exist.'
+    except XPI.BadZipfile:
+        return None, 'XPI cannot be unzipped.'
+    except XPI.BadXPIfile:
+        return None, 'XPI is not properly configured.'
+    return xpi, None
+
+
+def expand_xpi_paths(paths):
+    xpi_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = glob.glob(os.path.join(path, '*.xpi'))
+        else:
+            matches = glob.glob(path)
+        for match in sorted(matches):
+            if match not in xpi_files:
+                xpi_files.append(match)
+    return xpi_files
+
+
+def plan_xpi_uploads(xpis, buckets, prefix, listing_ttl, xpi_cache):
+    """Work out where the XPIs of one add-on live in S3 without asking any questions.
+
+    Returns the listing they share and, for each XPI, the suffix to use and
+    whether it still has to be uploaded. Existing files are never replaced,
+    and XPIs with the same file name get different free suffixes.
+    """
+    from morgoth.s3 import find_uploaded_suffix
+
+    bucket = buckets.get()
+    listing = get_bucket_listing(
+        bucket, os.path.join(prefix, xpis[0].short_name, ''), ttl=listing_ttl)
+
+    plans = []
+    reserved = set()
+    for xpi in xpis:
+        known_keys = get_known_uploads(xpi_cache, xpi, bucket)
+        suffix = find_uploaded_suffix(xpi, bucket, listing, prefix, known_keys=known_keys)
+        if suffix is None and listing.refresh():
+            # A file is about to be written, so don't trust a cached listing
+            suffix = find_uploaded_suffix(xpi, bucket, listing, prefix, known_keys=known_keys)
+        if suffix is not None:
+            if xpi_cache:
+                xpi_cache.add_upload(
+                    xpi.sha512sum, bucket.name, xpi.get_ftp_path(prefix, suffix=suffix))
+            plans.append((suffix, False))
+            continue
+
+        suffix = ''
+        if xpi.get_ftp_path(prefix) in listing or xpi.get_ftp_path(prefix) in reserved:
+            suffix = listing.get_free_suffix(xpi, prefix, reserved=reserved)
+        reserved.add(xpi.get_ftp_path(prefix, suffix=suffix))
+        plans.append((suffix, True))
+    return listing, plans
+
+
+def upload_planned_xpi(xpi, buckets, upload_path, transfer_settings, xpi_cache):
+    from morgoth.s3 import upload_file
+
+    bucket = buckets.get()
+    upload_file(
+        bucket, upload_path, xpi.path, xpi.sha512sum, metadata=get_upload_metadata(xpi),
+        **transfer_settings)
+    if xpi_cache:
+        xpi_cache.add_upload(xpi.sha512sum, bucket.name, upload_path)
+    return upload_path
+
+
+def output_http_error(err, verbose):
+    output(f'An error occured: HTTP {err.response.status_code}', Fore.RED)
+    if verbose:
+        output('Request headers:')
+        output(json.dumps(dict(err.request.headers), indent=2))
+        if err.request.body:
+            output('Request body:')
+            output(json.dumps(json.loads(err.request.body.decode()), indent=2))
+        output('Error from server:')
+        output(json.dumps(err.response.json(), indent=2))
+
+
+@make.command('releases')
+@click.option('--bearer', '-b', default=None)
+@click.option('--profile', default=None)
+@click.option('--verbose', '-v', is_flag=True)
+@click.option('--superblob', is_flag=True)
+@click.option('--workers', '-j', type=int, default=None)
+@click.argument('paths', nargs=-1)
+def make_releases(paths, bearer, profile, verbose, superblob, workers):
+    """Make new releases from many XPI files."""
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+    from requests.exceptions import HTTPError
+
+    from morgoth.s3 import BucketPool
+
+    prefix = settings.get('aws.prefix', DEFAULT_AWS_PREFIX)
+    base_url = settings.get('aws.base_url', DEFAULT_AWS_BASE_URL)
+    transfer_settings = get_transfer_settings()
+
+    xpi_files = expand_xpi_paths(paths)
+    if not xpi_files:
+        output('No XPI files found.', Fore.RED)
+        exit(1)
+
+    # Parsing and hashing is CPU bound, so spread it across processes
+    output(f'Reading {len(xpi_files)} XPI files...', Fore.BLUE)
+    with timings.phase('read XPIs'), ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(load_xpi, xpi_files))
+
+    xpis = []
+    seen_hashes = set()
+    for path, (xpi, error) in zip(xpi_files, results):
+        if error:
+            output(f'{path}: {error}', Fore.RED)
+            exit(1)
+        if xpi.archived:
+            output(f'{path}: Archived XPIs cannot be released in a batch.', Fore.RED)
+            exit(1)
+        if xpi.sha512sum not in seen_hashes:
+            seen_hashes.add(xpi.sha512sum)
+            xpis.append(xpi)
+
+    # S3 calls are I/O bound, so share one session across a pool of threads
+    session = get_boto3_session(profile)
+    buckets = BucketPool(session, settings.get('aws.bucket_name', DEFAULT_AWS_BUCKET_NAME))
+    listing_ttl = int(settings.get('aws.listing_cache_ttl', 0))
+    xpi_cache = get_xpi_cache()
+
+    # XPIs of the same add-on share a listing, so plan them together
+    groups = {}
+    for xpi in xpis:
+        groups.setdefault(xpi.short_name, []).append(xpi)
+    with timings.phase('S3 checks'), \
+            ThreadPoolExecutor(max_workers=transfer_settings['max_concurrency']) as executor:
+        results = list(executor.map(
+            lambda group: plan_xpi_uploads(group, buckets, prefix, listing_ttl, xpi_cache),
+            groups.values()))
+    listings = {}
+    planned = {}
+    for group, (listing, group_plans) in zip(groups.values(), results):
+        listings[group[0].short_name] = listing
+        planned.update(zip(group, group_plans))
+    plans = [planned[xpi] for xpi in xpis]
+
+    extra_kw = {}
+    if bearer:
+        extra_kw.update({"bearer_token": bearer})
+    environment = get_validated_environment(verbose=verbose, **extra_kw)
+
+    # Releases left behind by an earlier, interrupted batch are skipped
+    with timings.phase('fetch release names'):
+        existing_names = get_release_names(environment)
+
+    output('')
+    release_names = []
+    for xpi, (suffix, needs_upload) in zip(xpis, plans):
+        release_name = '{}{}'.format(xpi.release_name, suffix)
+        release_names.append(release_name)
+        upload_path = xpi.get_ftp_path(prefix, suffix=suffix)
+        if needs_upload:
+            output(f'{release_name}: will upload to {upload_path}', Fore.CYAN)
+        else:
+            output(f'{release_name}: already uploaded to {upload_path}', Fore.GREEN)
+        if release_name in existing_names:
+            output(f'{release_name}: release exists', Fore.GREEN)
+
+    if superblob:
+        sb_data = get_superblob_data(release_names)
+        if sb_data['name'] in existing_names:
+            output(f'Release exists: {sb_data["name"]}', Fore.GREEN)
+        else:
+            output(f'Will add new release {sb_data["name"]}')
+    output('')
+
+    if not click.confirm('Upload these XPIs and releases to Balrog?'):
+        output('Aborting.', Fore.RED)
+        exit(1)
+
+    with timings.phase('S3 upload'), \
+            ThreadPoolExecutor(max_workers=transfer_settings['max_concurrency']) as executor:
+        futures = {
+            executor.submit(
+                upload_planned_xpi, xpi, buckets, xpi.get_ftp_path(prefix, suffix=suffix),
+                transfer_settings, xpi_cache): xpi
+            for xpi, (suffix, needs_upload) in zip(xpis, plans) if needs_upload
+        }
+        for future, xpi in futures.items():
+            upload_path = future.result()
+            listings[xpi.short_name].add(upload_path)
+            output('XPI uploaded to: {}'.format(upload_path), Fore.GREEN)
+
+    blobs = [
+        xpi.generate_release_data(base_url=base_url, prefix=prefix, suffix=suffix)
+        for xpi, (suffix, needs_upload) in zip(xpis, plans)
+        if '{}{}'.format(xpi.release_name, suffix) not in existing_names
+    ]
+    if superblob and sb_data['name'] not in existing_names:
+        blobs.append(sb_data)
+
+    for blob in blobs:
+        try:
+            with timings.phase('Balrog upload'):
+                environment.request('releases', data={
+                    'blob': json.dumps(blob),
+                    'name': blob['name'],
+                    'product': 'SystemAddons',
+                })
+        except HTTPError as err:
+            output(f'Unable to create release {blob["name"]}', Fore.RED)
+            output_http_error(err, verbose)
+            exit(1)
+        output('Uploaded: {}{}'.format(Style.BRIGHT, blob['name']))
+
+    output('')
+
+
+def make_superblobs_from_dir(from_dir, patterns, snapshot_path, verbose, **extra_kw):
+    """Make a superblob for each glob pattern of release files in a directory."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    from requests.exceptions import HTTPError
+
+    groups = {}
+    for pattern in patterns:
+        paths = sorted(glob.glob(os.path.join(from_dir, pattern), recursive=True))
+        if not paths:
+            output(f'No release files match: {pattern}', Fore.RED)
+            exit(1)
+        groups[pattern] = paths
+
+    # Only the top level names are read, so this is mostly waiting on the disk
+    all_paths = sorted({path for paths in groups.values() for path in paths})
+    with timings.phase('read releases'), ThreadPoolExecutor() as executor:
+        names = dict(zip(all_paths, executor.map(read_release_name, all_paths)))
+
+    unnamed = [path for path, name in names.items() if not isinstance(name, str)]
+    if unnamed:
+        output(f'These files have no release name: {", ".join(unnamed)}', Fore.RED)
+        exit(1)
+
+    environment = get_environment(snapshot_path, verbose=verbose, **extra_kw)
+    with timings.phase('fetch release names'):
+        release_names = get_release_names(environment)
+
+    missing = sorted(set(names.values()) - release_names)
+    if missing:
+        output(f'These releases do not exist: {", ".join(missing)}', Fore.RED)
+        exit(1)
+
+    superblobs = {}
+    for pattern, paths in groups.items():
+        sb_data = get_superblob_data({names[path] for path in paths})
+        output(f'{pattern}: {len(sb_data["blobs"])} releases')
+        output(f'  {Style.BRIGHT}{sb_data["name"]}')
+        if sb_data['name'] in release_names:
+            output('  Already exists.', Fore.YELLOW)
+        superblobs[sb_data['name']] = sb_data
+    new_superblobs = [
+        sb_data for name, sb_data in superblobs.items() if name not in release_names]
+    output('')
+
+    if not snapshot_path and new_superblobs and click.confirm(
+            f'Upload {len(new_superblobs)} new superblobs to Balrog?'):
+        with timings.phase('Balrog upload'):
+            results = request_concurrently(environment, [
+                ('releases', {
+                    'blob': json.dumps(sb_data),
+                    'name': sb_data['name'],
+                    'product': 'SystemAddons',
+                })
+                for sb_data in new_superblobs
+            ])
+
+        failed = False
+        for sb_data, result in zip(new_superblobs, results):
+            if isinstance(result, HTTPError):
+                output(f'Unable to upload {sb_data["name"]}', Fore.RED)
+                output_http_error(result, verbose)
+                failed = True
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                output('Uploaded: {}{}'.format(Style.BRIGHT, sb_data['name']))
+        if failed:
+            exit(1)
+    elif click.confirm('Save superblobs to files?'):
+        for sb_data in superblobs.values():
+            output('Saving to: {}{}'.format(Style.BRIGHT, save_superblob(sb_data)))
+    else:
+        for sb_data in superblobs.values():
+            output(json.dumps(sb_data, indent=2, sort_keys=True))
+
+    output('')
+
+
 @make.command('superblob')
 @click.option('--bearer', '-b', default=None)
 @click.option('--verbose', '-v', is_flag=True)
+@click.option('--snapshot', 'snapshot_path', type=click.Path(dir_okay=False), default=None,
+              help='Check the releases against a snapshot instead of uploading.')
+@click.option('--from-dir', type=click.Path(exists=True, file_okay=False), default=None,
+              help='Make superblobs from the release files in a directory.')
+@click.option('--glob', 'patterns', multiple=True,
+              help='Release files for one superblob, relative to --from-dir. Repeatable.')
 @click.argument('releases', nargs=-1)
-def make_superblob(releases, bearer, verbose):
+def make_superblob(releases, bearer, verbose, snapshot_path, from_dir, patterns):
     """Make a new superblob from releases."""
+    from requests.exceptions import HTTPError
+
+    extra_kw = {}
+    if bearer:
+        extra_kw.update({"bearer_token": bearer})
+
+    if from_dir:
+        if releases:
+            output('Pass either releases or --from-dir, not both.', Fore.RED)
+            exit(1)
+        make_superblobs_from_dir(
+            from_dir, patterns or (DEFAULT_RELEASE_GLOB,), snapshot_path, verbose, **extra_kw)
+        return
+    elif patterns:
+        output('--glob can only be used with --from-dir.', Fore.RED)
+        exit(1)
+
     names = []
 
-    for release in releases:
-        if os.path.exists(release):
-            with open(release, 'r') as f:
-                release_data = json.loads(f.read())
-            names.append(release_data['name'])
-        else:
-            names.append(release)
+    with timings.phase('read releases'):
+        for release in releases:
+            if os.path.exists(release):
+                names.append(read_release_name(release))
+            else:
+                names.append(release)
 
     if not len(names):
         output('No releases specified.', Fore.RED)
         exit(1)
 
-    names.sort()
-    names_string = '-'.join(names)
-    names_hash = sha256(names_string.encode()).hexdigest()
+    sb_data = get_superblob_data(names)
+    sb_name = sb_data['name']
 
-    sb_name = 'Superblob-{}'.format(names_hash)
-    sb_data = {
-      'blobs': names,
-      'name': sb_name,
-      'schema_version': 4000
-    }
+    if snapshot_path:
+        release_names = get_release_names(get_environment(snapshot_path))
+        missing = [name for name in names if name not in release_names]
+        if missing:
+            output(f'These releases are not in the snapshot: {", ".join(missing)}', Fore.RED)
+            exit(1)
+        if sb_name in release_names:
+            output(f'The snapshot already has this superblob: {sb_name}', Fore.YELLOW)
 
-    if click.confirm('Upload release to Balrog?'):
-        extra_kw = {}
-        if bearer:
-            extra_kw.update({"bearer_token": bearer})
+    if not snapshot_path and click.confirm('Upload release to Balrog?'):
         environment = get_validated_environment(verbose=verbose, **extra_kw)
 
         try:
-            environment.request('releases', data={
-                'blob': json.dumps(sb_data),
-                'name': sb_name,
-                'product': 'SystemAddons',
-            })
+            with timings.phase('Balrog upload'):
+                environment.request('releases', data={
+                    'blob': json.dumps(sb_data),
+                    'name': sb_name,
+                    'product': 'SystemAddons',
+                })
         except HTTPError as err:
-            output(f'An error occured: HTTP {err.response.status_code}', Fore.RED)
-            if verbose:
-                output('Request headers:')
-                output(json.dumps(dict(err.request.headers), indent=2))
-                output('Request body:')
-                output(json.dumps(json.loads(err.request.body.decode()), indent=2))
-                output('Error from server:')
-                output(json.dumps(err.response.json(), indent=2))
+            output_http_error(err, verbose)
             exit(1)
 
         output('Uploaded: {}{}'.format(Style.BRIGHT, sb_name))
     elif click.confirm('Save release to file?'):
-        sb_path = 'releases/superblobs/{}.json'.format(sb_name)
-        os.makedirs('releases/superblobs', exist_ok=True)
-        with open(sb_path, 'w') as f:
-            f.write(json.dumps(sb_data, indent=2, sort_keys=True))
+        sb_path = save_superblob(sb_data)
 
         output('Saving to: {}{}'.format(Style.BRIGHT, sb_path))
     else:
@@ -321,17 +916,29 @@ def modify():
 @click.argument('rule_ids', nargs=-1)
 @click.option('--bearer', '-b', default=None)
 @click.option('--verbose', '-v', is_flag=True)
-def modify_rules(rule_ids, bearer, verbose):
+@click.option('--dry-run', is_flag=True, help='Show the changes without making them.')
+@click.option('--snapshot', 'snapshot_path', type=click.Path(dir_okay=False), default=None,
+              help='Read rules and releases from a snapshot. Requires --dry-run.')
+def modify_rules(rule_ids, bearer, verbose, dry_run, snapshot_path):
     """Modify rules."""
+    from requests.exceptions import HTTPError
+
+    if snapshot_path and not dry_run:
+        output('Snapshots can only be used with --dry-run.', Fore.RED)
+        exit(1)
+
     extra_kw = {}
     if bearer:
         extra_kw.update({"bearer_token": bearer})
-    environment = get_validated_environment(verbose=verbose)
+    environment = get_environment(snapshot_path, verbose=verbose)
+
+    # Fetch every rule and the release it maps to up front
+    output('Fetching rules...', Fore.BLUE)
+    with timings.phase('fetch rules'):
+        rules, superblobs = prefetch_rules(environment, rule_ids, mappings=True)
 
-    # Fetch a list of all releases
-    data = environment.request('releases').json()
-    releases = data.get('releases', [])
-    release_names = [r.get('name') for r in releases if r.get('product') == 'SystemAddons']
+    with timings.phase('fetch release names'):
+        release_names = get_release_names(environment)
 
     # Check for releases to be added
     adds = []
@@ -365,46 +972,29 @@ def modify_rules(rule_ids, bearer, verbose):
         output(f'Removing: {", ".join(removes)}', Style.BRIGHT)
     output('')
 
-    for rule_id in rule_ids:
-        # Fetch existing rule
-        rule = environment.fetch(f'rules/{rule_id}')
-
-        # Fetch release for rule
-        superblob = environment.fetch(f'releases/{rule["mapping"]}')
-
-        # Handle rules that are not using the superblob schema
-        if not superblob["schema_version"] == 4000:
-            new_release = {
-                "blobs": [],
-                "name": "",
-                "schema_version": 4000
-            }
+    # Rules sharing a mapping share the same new superblob
+    new_superblobs = get_modified_superblobs(superblobs, adds, removes)
 
-            if superblob.get("schema") == 5000:
-                new_release["blobs"].append(superblob["name"])
-
-            superblob = new_release
+    new_releases = {}
+    rule_changes = []
+    for rule_id in rule_ids:
+        rule = rules[rule_id]
+        current_blobs = get_superblob_blobs(superblobs[rule['mapping']])
+        superblob = new_superblobs[rule['mapping']]
 
-        # Construct new superblob with release
-        for add in adds:
-            if add and add not in superblob['blobs']:
+        for add in dict.fromkeys(adds):
+            if add in superblob['blobs'] and add not in current_blobs:
                 output(f'+ Adding: {add}', Fore.GREEN)
-                superblob['blobs'].append(add)
-        for remove in removes:
-            if remove and remove in superblob['blobs']:
+        for remove in dict.fromkeys(removes):
+            if remove in current_blobs and remove not in superblob['blobs']:
                 output(f'- Removing: {remove}', Fore.RED)
-                superblob['blobs'].remove(remove)
 
-        if len(superblob['blobs']) > 0:
-            superblob['blobs'].sort()
-            name_hash = sha256('-'.join(superblob['blobs']).encode()).hexdigest()
-            superblob['name'] = f'Superblob-{name_hash}'
-        else:
+        if not superblob['blobs']:
             output('All addons were removed.', Fore.YELLOW)
-            superblob['name'] = 'SystemAddons-no-update'
 
-        # Check if the superblob already exists
-        create_release = superblob['name'] not in release_names
+        # Check if the superblob already exists or will be created for an earlier rule
+        create_release = (
+            superblob['name'] not in release_names and superblob['name'] not in new_releases)
 
         # Check if the mapping is already set
         update_mapping = rule['mapping'] != superblob['name']
@@ -420,7 +1010,9 @@ def modify_rules(rule_ids, bearer, verbose):
             output(f'From mapping: {Style.BRIGHT}{rule["mapping"]}')
             output(f'To mapping: {Style.BRIGHT}{superblob["name"]}\n')
 
-        if update_mapping or create_release:
+        if (update_mapping or create_release) and dry_run:
+            output('')
+        elif update_mapping or create_release:
             if not click.confirm('Apply these changes?'):
                 output('Skipped.\n', Fore.YELLOW)
                 continue
@@ -428,43 +1020,51 @@ def modify_rules(rule_ids, bearer, verbose):
             output(f'Skipping rule {rule_id}, nothing to change.', Fore.YELLOW)
             continue
 
-        # Create release
         if create_release:
-            try:
-                environment.request('releases', data={
-                    'blob': json.dumps(superblob),
-                    'name': superblob['name'],
-                    'product': 'SystemAddons',
-                })
-            except HTTPError as err:
-                output('Unable to create release', Fore.RED)
-                output(f'An error occured: HTTP {err.response.status_code}', Fore.RED)
-                if verbose:
-                    output('Request headers:')
-                    output(json.dumps(dict(err.request.headers), indent=2))
-                    output('Request body:')
-                    output(json.dumps(json.loads(err.request.body.decode()), indent=2))
-                    output('Error from server:')
-                    output(json.dumps(err.response.json(), indent=2))
-                exit(1)
-            release_names.append(superblob['name'])
-
-        # Save new mapping to rule
+            new_releases[superblob['name']] = superblob
         if update_mapping:
-            ts_now = int(datetime.now().timestamp() * 1000)
-            rule['mapping'] = superblob['name']
-            try:
+            rule_changes.append((rule_id, rule, superblob['name']))
+
+    if dry_run:
+        output('Dry run, no changes were made.', Fore.YELLOW)
+        exit(0)
+
+    # Create every new release in one batch before any rule points at them
+    with timings.phase('create releases'):
+        results = request_concurrently(environment, [
+            ('releases', {
+                'blob': json.dumps(superblob),
+                'name': superblob['name'],
+                'product': 'SystemAddons',
+            })
+            for superblob in new_releases.values()
+        ])
+
+    for result in results:
+        if isinstance(result, HTTPError):
+            output('Unable to create release', Fore.RED)
+            output_http_error(result, verbose)
+            exit(1)
+        elif isinstance(result, Exception):
+            raise result
+
+    # Save new mappings to rules
+    for rule_id, rule, mapping in rule_changes:
+        ts_now = int(datetime.now().timestamp() * 1000)
+        rule['mapping'] = mapping
+        try:
+            with timings.phase('schedule changes'):
                 environment.request('scheduled_changes/rules', data={
                     **rule,
                     'when': ts_now + (5 * 1000),  # in five seconds
                     'change_type': 'update',
                 })
-            except HTTPError as err:
-                response_data = err.response.json()
-                output('Unable to update rule!', Fore.RED)
-                if 'data' in response_data:
-                    output(response_data.get('data'), Fore.RED)
-                exit(1)
+        except HTTPError as err:
+            response_data = err.response.json()
+            output('Unable to update rule!', Fore.RED)
+            if 'data' in response_data:
+                output(response_data.get('data'), Fore.RED)
+            exit(1)
 
     output('Done!', Fore.GREEN)
 
@@ -479,48 +1079,563 @@ def promote():
 @click.argument('rule_ids', nargs=-1)
 @click.option('--bearer', '-b', default=None)
 @click.option('--verbose', '-v', is_flag=True)
-def promote_rules(rule_ids, bearer, verbose):
+@click.option('--batch', is_flag=True,
+              help='Confirm all the rules at once and schedule them concurrently.')
+@click.option('--rate', type=click.FloatRange(min=0, min_open=True),
+              default=DEFAULT_SCHEDULE_RATE,
+              help='Maximum scheduled changes posted per second in batch mode.')
+@click.option('--wait', is_flag=True, help='Wait until the scheduled changes are enacted.')
+@click.option('--timeout', type=int, default=DEFAULT_WAIT_TIMEOUT,
+              help='Seconds to wait for the scheduled changes with --wait.')
+def promote_rules(rule_ids, bearer, verbose, batch, rate, wait, timeout):
     """Promote rules."""
+    from requests.exceptions import HTTPError
+
     extra_kw = {}
     if bearer:
         extra_kw.update({"bearer_token": bearer})
     environment = get_validated_environment(verbose=verbose)
+    with timings.phase('fetch rules'):
+        rules, _ = prefetch_rules(environment, rule_ids)
 
+    promotions = []
     for rule_id in rule_ids:
-        # Fetch existing rule
-        rule = environment.fetch(f'rules/{rule_id}')
+        rule = rules[rule_id]
 
         # Check the channel is a test channel
         if "-sysaddon" not in rule.get("channel"):
             output(f"Rule {rule_id} does not have a `-sysaddon` suffix in the channel.", Fore.RED)
             continue
 
-        ts_now = int(datetime.now().timestamp() * 1000)
-
         updated_channel = rule.get("channel").replace("-sysaddon", "")
 
-        # Confirm the change is expected and update
-        if not click.confirm(f"Rule {rule_id} updated to `{updated_channel}`. Continue?"):
+        if batch:
+            output(f"Rule {rule_id} will be updated to `{updated_channel}`.")
+        elif not click.confirm(f"Rule {rule_id} updated to `{updated_channel}`. Continue?"):
+            # Confirm the change is expected and update
             output("Skipping...")
             continue
 
         rule["channel"] = updated_channel
         del rule["rule_id"]
-        try:
-            environment.request('scheduled_changes/rules', data={
-                **rule,
-                'when': ts_now + (5 * 1000),  # in five seconds
-                'change_type': 'insert',
-            })
-            output("Updated!", Fore.GREEN)
-        except HTTPError as err:
-            response_data = err.response.json()
-            output('Unable to update rule!', Fore.RED)
+        promotions.append((rule_id, rule))
+
+    if batch and promotions and not click.confirm(f'Promote {len(promotions)} rules?'):
+        output('Aborting.', Fore.RED)
+        exit(1)
+
+    def schedule(rule):
+        ts_now = int(datetime.now().timestamp() * 1000)
+        return ('scheduled_changes/rules', {
+            **rule,
+            'when': ts_now + (5 * 1000),  # in five seconds
+            'change_type': 'insert',
+        })
+
+    start = time.monotonic()
+    if batch:
+        from morgoth.environment import RateLimiter
+
+        with timings.phase('schedule changes'):
+            results = request_concurrently(
+                environment, [schedule(rule) for _, rule in promotions],
+                rate_limiter=RateLimiter(rate))
+    else:
+        results = []
+        for _, rule in promotions:
+            try:
+                with timings.phase('schedule changes'):
+                    results.append(environment.request(*schedule(rule)))
+            except HTTPError as err:
+                results.append(err)
+                break
+
+    sc_ids = {}
+    failed = False
+    for (rule_id, _), result in zip(promotions, results):
+        if isinstance(result, HTTPError):
+            response_data = result.response.json()
+            output(f'Unable to update rule {rule_id}!', Fore.RED)
             if verbose:
                 output(response_data, Fore.RED)
             else:
                 if 'data' in response_data:
                     output(response_data.get('data'), Fore.RED)
+            failed = True
+        elif isinstance(result, Exception):
+            raise result
+        else:
+            output(f"Rule {rule_id} updated!", Fore.GREEN)
+            sc_ids[result.json().get('sc_id')] = rule_id
+    if failed:
+        exit(1)
+
+    if wait and sc_ids:
+        output('Waiting for the scheduled changes to be enacted...', Fore.BLUE)
+        with timings.phase('wait for scheduled changes'):
+            pending = wait_for_scheduled_changes(environment, sc_ids, timeout)
+        if pending:
+            for sc_id in sorted(pending):
+                output(f'Rule {sc_ids[sc_id]} was not enacted (scheduled change {sc_id}).',
+                       Fore.RED)
             exit(1)
+        output(f'All changes enacted in {time.monotonic() - start:.1f}s.', Fore.GREEN)
 
     output('Done!', Fore.GREEN)
+
+
+def output_plan(plan_data):
+    for release in plan_data['releases']:
+        output(f'Will add new release {release["name"]}:')
+        output('{}\n'.format(json.dumps(release, indent=2)), Style.BRIGHT)
+
+    for change in plan_data['rule_changes']:
+        rule = change['rule']
+        output(f'Will modify: {Style.BRIGHT}Rule {change["rule_id"]} '
+               f'(channel: {rule["channel"]}, version: {rule["version"]})')
+        output(f'From mapping: {Style.BRIGHT}{change["from"]}')
+        output(f'To mapping: {Style.BRIGHT}{change["to"]}\n')
+
+
+@cli.group()
+def plan():
+    """Plan changes to objects."""
+    pass
+
+
+@plan.command('rules')
+@click.argument('rule_ids', nargs=-1)
+@click.option('--add', '-a', 'adds', multiple=True)
+@click.option('--remove', '-r', 'removes', multiple=True)
+@click.option('--changeset', type=click.File('r'), default=None)
+@click.option('--output', '-o', 'plan_path', default='plan.json')
+@click.option('--snapshot', 'snapshot_path', type=click.Path(dir_okay=False), default=None,
+              help='Plan against a snapshot instead of the server.')
+@click.option('--bearer', '-b', default=None)
+@click.option('--verbose', '-v', is_flag=True)
+def plan_rules(rule_ids, adds, removes, changeset, plan_path, snapshot_path, bearer, verbose):
+    """Plan adding and removing releases on rules."""
+    from morgoth.plan import build_rules_plan, save_plan
+
+    rule_ids = list(rule_ids)
+    adds = list(adds)
+    removes = list(removes)
+    if changeset:
+        changes = json.load(changeset)
+        rule_ids += [str(rule_id) for rule_id in changes.get('rules', [])]
+        adds += changes.get('add', [])
+        removes += changes.get('remove', [])
+
+    if not rule_ids:
+        output('No rules specified.', Fore.RED)
+        exit(1)
+
+    if len(adds) + len(removes) == 0:
+        output('No changes to be made.', Fore.YELLOW)
+        exit(0)
+
+    extra_kw = {}
+    if bearer:
+        extra_kw.update({"bearer_token": bearer})
+    environment = get_environment(snapshot_path, verbose=verbose, **extra_kw)
+
+    output('Fetching rules...', Fore.BLUE)
+    with timings.phase('fetch rules'):
+        rules, releases = prefetch_rules(environment, rule_ids, mappings=True)
+
+    with timings.phase('fetch release names'):
+        release_names = get_release_names(environment)
+
+    missing = [add for add in adds if add not in release_names]
+    if missing:
+        output(f'These releases do not exist: {", ".join(missing)}', Fore.RED)
+        exit(1)
+
+    plan_data = build_rules_plan(rules, releases, release_names, adds, removes, environment.url)
+
+    output('')
+    output_plan(plan_data)
+    if not plan_data['releases'] and not plan_data['rule_changes']:
+        output('No changes to be made.', Fore.YELLOW)
+        exit(0)
+
+    save_plan(plan_data, plan_path)
+    output(f'Plan saved to: {Style.BRIGHT}{plan_path}')
+
+
+@cli.command()
+@click.argument('plan_path')
+@click.option('--bearer', '-b', default=None)
+@click.option('--verbose', '-v', is_flag=True)
+def apply(plan_path, bearer, verbose):
+    """Apply a saved plan."""
+    from requests.exceptions import HTTPError
+
+    from morgoth.plan import PlanError, load_plan
+
+    try:
+        plan_data = load_plan(plan_path)
+    except PlanError as err:
+        output(str(err), Fore.RED)
+        exit(1)
+
+    output_plan(plan_data)
+    if not plan_data['releases'] and not plan_data['rule_changes']:
+        output('No changes to be made.', Fore.YELLOW)
+        exit(0)
+
+    if not click.confirm('Apply these changes?'):
+        output('Aborting.', Fore.RED)
+        exit(1)
+
+    extra_kw = {}
+    if bearer:
+        extra_kw.update({"bearer_token": bearer})
+    environment = get_validated_environment(
+        url=plan_data['balrog_url'], verbose=verbose, **extra_kw)
+
+    # Plans can be made from snapshots or long before they are applied, so
+    # make sure nobody has changed the rules or made the releases since.
+    # Fetched directly, so nothing cached can hide a change.
+    rule_changes = plan_data['rule_changes']
+    with timings.phase('check for changes'):
+        results = request_concurrently(environment, [
+            (f'rules/{change["rule_id"]}', None) for change in rule_changes
+        ] + [
+            (f'releases/{release["name"]}', None) for release in plan_data['releases']
+        ])
+
+    drifted = False
+    new_releases = []
+    for release, result in zip(plan_data['releases'], results[len(rule_changes):]):
+        if isinstance(result, HTTPError) and result.response.status_code == 404:
+            new_releases.append(release)
+        elif isinstance(result, HTTPError):
+            output(f'Unable to fetch release {release["name"]}', Fore.RED)
+            output_http_error(result, verbose)
+            drifted = True
+        elif isinstance(result, Exception):
+            raise result
+        elif result.json() == release:
+            output(f'Release exists: {release["name"]}', Fore.GREEN)
+        else:
+            output(f'Release {release["name"]} exists and differs from the plan.', Fore.RED)
+            drifted = True
+
+    for change, result in zip(rule_changes, results):
+        if isinstance(result, HTTPError):
+            output(f'Unable to fetch rule {change["rule_id"]}', Fore.RED)
+            output_http_error(result, verbose)
+            drifted = True
+            continue
+        elif isinstance(result, Exception):
+            raise result
+        planned_version = change['rule'].get('data_version')
+        current_version = result.json().get('data_version')
+        if current_version != planned_version:
+            output(f'Rule {change["rule_id"]} has changed since the plan was made '
+                   f'(data_version {planned_version} is now {current_version}).', Fore.RED)
+            drifted = True
+    if drifted:
+        output('Make a new plan and try again.', Fore.RED)
+        exit(1)
+
+    # Every release has to exist before any rule can be pointed at it
+    with timings.phase('create releases'):
+        results = request_concurrently(environment, [
+            ('releases', {
+                'blob': json.dumps(release),
+                'name': release['name'],
+                'product': 'SystemAddons',
+            })
+            for release in new_releases
+        ])
+
+    failed = False
+    for release, result in zip(new_releases, results):
+        if isinstance(result, HTTPError):
+            output(f'Unable to create release {release["name"]}', Fore.RED)
+            output_http_error(result, verbose)
+            failed = True
+        elif isinstance(result, Exception):
+            raise result
+        else:
+            output(f'Created: {Style.BRIGHT}{release["name"]}')
+    if failed:
+        exit(1)
+
+    ts_now = int(datetime.now().timestamp() * 1000)
+    with timings.phase('schedule changes'):
+        results = request_concurrently(environment, [
+            ('scheduled_changes/rules', {
+                **change['rule'],
+                'when': ts_now + (5 * 1000),  # in five seconds
+                'change_type': 'update',
+            })
+            for change in plan_data['rule_changes']
+        ])
+
+    for change, result in zip(plan_data['rule_changes'], results):
+        if isinstance(result, HTTPError):
+            output(f'Unable to update rule {change["rule_id"]}!', Fore.RED)
+            response_data = result.response.json()
+            if 'data' in response_data:
+                output(response_data.get('data'), Fore.RED)
+            failed = True
+        elif isinstance(result, Exception):
+            raise result
+        else:
+            output(f'Scheduled: {Style.BRIGHT}Rule {change["rule_id"]} -> {change["to"]}')
+    if failed:
+        exit(1)
+
+    output('Done!', Fore.GREEN)
+
+
+@cli.command()
+@click.option('--bearer', '-b', default=None)
+@click.option('--verbose', '-v', is_flag=True)
+@click.option('--full', is_flag=True, help='Rebuild the index from scratch.')
+def sync(bearer, verbose, full):
+    """Sync the local index of rules and releases."""
+    from morgoth.index import ReleaseIndex
+
+    extra_kw = {}
+    if bearer:
+        extra_kw.update({"bearer_token": bearer})
+    environment = get_validated_environment(verbose=verbose, **extra_kw)
+
+    index = ReleaseIndex()
+    if full:
+        index.clear()
+
+    output('Syncing...', Fore.BLUE)
+    with timings.phase('sync index'):
+        stats = index.sync(environment)
+
+    output(f'Rules: {stats["rules"]} ({stats["rules_updated"]} updated, '
+           f'{stats["rules_removed"]} removed)')
+    output(f'Releases: {stats["releases"]} ({stats["releases_updated"]} updated, '
+           f'{stats["releases_removed"]} removed)')
+    output('Done!', Fore.GREEN)
+
+
+def get_synced_index():
+    from morgoth.index import ReleaseIndex
+
+    index = ReleaseIndex()
+    if index.get_meta('url') is None:
+        output('The local index is empty. Run `morgoth sync` first.', Fore.RED)
+        exit(1)
+    return index
+
+
+def output_rule(rule, indent=''):
+    output(f'{indent}Rule {rule["rule_id"]} '
+           f'(channel: {rule.get("channel")}, version: {rule.get("version")}, '
+           f'mapping: {rule.get("mapping")})')
+
+
+@cli.command()
+@click.option('--addon', required=True, help='The ID of the addon.')
+@click.option('--version', default=None, help='Only match this version of the addon.')
+def find(addon, version):
+    """Find the releases and rules shipping an addon."""
+    results = get_synced_index().find_addon(addon, version)
+    if not results:
+        output('No releases found.', Fore.YELLOW)
+        exit(0)
+
+    for result in results:
+        output(f'{Style.BRIGHT}{result["release"]}{Style.RESET_ALL} '
+               f'(version: {result["version"]})')
+        for rule in result['rules']:
+            output_rule(rule, indent='  ')
+        if not result['rules']:
+            output('  Not shipped by any rule.', Fore.YELLOW)
+
+
+@cli.command('rules')
+@click.option('--mapping', required=True, help='The name of the mapped release.')
+def list_rules(mapping):
+    """List the rules mapped to a release."""
+    rules = get_synced_index().find_rules(mapping)
+    if not rules:
+        output('No rules found.', Fore.YELLOW)
+        exit(0)
+
+    for rule in rules:
+        output_rule(rule)
+
+
+@cli.command()
+@click.argument('release_names', nargs=-1, required=True)
+@click.option('--concurrency', '-j', type=int, default=None,
+              help='Maximum files to fetch at once.')
+@click.option('--per-host', type=int, default=None,
+              help='Maximum connections to each host.')
+@click.option('--bearer', '-b', default=None)
+@click.option('--verbose', '-v', is_flag=True)
+def verify(release_names, concurrency, per_host, bearer, verbose):
+    """Check hosted XPIs match their releases."""
+    import asyncio
+
+    from urllib.parse import unquote
+
+    from requests.exceptions import HTTPError
+
+    from morgoth.environment import AsyncEnvironment
+    from morgoth.verify import (
+        DEFAULT_CONCURRENCY, DEFAULT_CONNECTIONS_PER_HOST, get_hosted_files,
+        verify_hosted_files)
+
+    extra_kw = {}
+    if bearer:
+        extra_kw.update({"bearer_token": bearer})
+    environment = get_validated_environment(verbose=verbose, **extra_kw)
+
+    output('Fetching releases...', Fore.BLUE)
+    try:
+        with timings.phase('fetch releases'):
+            with AsyncEnvironment(environment, concurrency=environment.pool_size) as \
+                    async_environment:
+                releases = asyncio.run(
+                    async_environment.fetch_releases(release_names, expand=True))
+    except HTTPError as err:
+        release_name = unquote(err.response.url.split('?')[0].rsplit('/', 1)[-1])
+        output(f'Unable to fetch release {release_name}', Fore.RED)
+        output_http_error(err, verbose)
+        exit(1)
+
+    hosted_files = get_hosted_files(releases.values())
+    output(f'Verifying {len(hosted_files)} files...', Fore.BLUE)
+
+    failures = 0
+    with timings.phase('verify files'):
+        verifications = verify_hosted_files(
+            hosted_files,
+            concurrency=concurrency or DEFAULT_CONCURRENCY,
+            connections_per_host=per_host or DEFAULT_CONNECTIONS_PER_HOST)
+        for verification in verifications:
+            hosted_file = verification.hosted_file
+            if verification.ok:
+                output(f'OK: {hosted_file.url}', Fore.GREEN)
+                continue
+
+            failures += 1
+            output(f'FAILED: {hosted_file.url}', Fore.RED)
+            output(f'  Releases: {", ".join(hosted_file.releases)}')
+            if verification.error:
+                output(f'  Error: {verification.error}', Fore.RED)
+                continue
+            if not verification.size_matches:
+                output(f'  Expected size: {hosted_file.size}')
+                output(f'  Actual size: {verification.size}')
+            if not verification.hash_matches:
+                output(f'  Expected {hosted_file.hash_function}: {hosted_file.hash_value}')
+                output(f'  Actual {hosted_file.hash_function}: {verification.hash_value}')
+
+    if failures:
+        output(f'{failures} of {len(hosted_files)} files did not match.', Fore.RED)
+        exit(1)
+    output('Done!', Fore.GREEN)
+
+
+@cli.command()
+def shell():
+    """Run commands in a session that keeps connections and caches."""
+    import shlex
+
+    try:
+        # Gives input() line editing and history where it is available
+        import readline  # noqa: F401
+    except ImportError:
+        pass
+
+    from morgoth.shell import SessionCache
+
+    global session_cache
+    session_cache = SessionCache()
+
+    output('Enter commands without `morgoth`. `stats` shows what the caches saved, '
+           '`clear` empties them and `exit` quits.', Fore.BLUE)
+    try:
+        while True:
+            try:
+                line = input('morgoth> ')
+            except KeyboardInterrupt:
+                output('')
+                continue
+            except EOFError:
+                output('')
+                break
+
+            try:
+                args = shlex.split(line)
+            except ValueError as err:
+                output(str(err), Fore.RED)
+                continue
+
+            if not args:
+                continue
+            elif args[0] in ('exit', 'quit'):
+                break
+            elif args[0] == 'stats':
+                output(session_cache.format_table(), Style.BRIGHT)
+            elif args[0] == 'clear':
+                session_cache.clear()
+                output('Caches cleared.', Fore.GREEN)
+            elif args[0] == 'shell':
+                output('Already in a shell.', Fore.YELLOW)
+            else:
+                try:
+                    cli.main(args, prog_name='morgoth', standalone_mode=False)
+                except click.Abort:
+                    output('Aborted!', Fore.RED)
+                except click.ClickException as err:
+                    err.show()
+                except SystemExit:
+                    # Commands exit early on errors and have already said why
+                    pass
+                except KeyboardInterrupt:
+                    output('')
+                    output('Aborted!', Fore.RED)
+                except Exception as err:
+                    # Keep the session and its caches for the next command
+                    output(f'{type(err).__name__}: {err}', Fore.RED)
+    finally:
+        session_cache = None
+
+
+@cli.group()
+def snapshot():
+    """Save Balrog state for offline use."""
+    pass
+
+
+@snapshot.command('save')
+@click.argument('snapshot_path', type=click.Path(dir_okay=False))
+@click.option('--bearer', '-b', default=None)
+@click.option('--verbose', '-v', is_flag=True)
+def snapshot_save(snapshot_path, bearer, verbose):
+    """Save the SystemAddons rules and releases to a file."""
+    from morgoth.index import ReleaseIndex
+    from morgoth.snapshot import Snapshot
+
+    extra_kw = {}
+    if bearer:
+        extra_kw.update({"bearer_token": bearer})
+    environment = get_validated_environment(verbose=verbose, **extra_kw)
+
+    # The local index only fetches what changed since it was last synced
+    index = ReleaseIndex()
+    output('Syncing...', Fore.BLUE)
+    with timings.phase('sync index'):
+        index.sync(environment)
+
+    with timings.phase('save snapshot'):
+        state = Snapshot.from_index(index)
+        state.save(snapshot_path)
+
+    output(f'Saved {len(state.rules)} rules and {len(state.releases)} releases to: '
+           f'{Style.BRIGHT}{snapshot_path}')
@@ -1,8 +1,29 @@
+import asyncio
+import functools
 import os
+import random
+import threading
+import time
 
 import requests
 
-from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor
+
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, ConnectTimeout, HTTPError, Timeout
+from urllib.parse import urlencode, urljoin
+
+from morgoth.timings import timings
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+MAX_BACKOFF = 30
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
 
 
 class Environment(object):
@@ -15,6 +36,20 @@ class Environment(object):
         self.session = requests.Session()
         self.session.headers.update({'Accept': 'application/json'})
 
+        self.pool_size = kwargs.get('pool_size', DEFAULT_POOL_SIZE)
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.timeout = (
+            kwargs.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT),
+            kwargs.get('read_timeout', DEFAULT_READ_TIMEOUT))
+        self.max_retries = kwargs.get('max_retries', DEFAULT_MAX_RETRIES)
+        self.backoff_factor = kwargs.get('backoff_factor', DEFAULT_BACKOFF_FACTOR)
+        self.cache = kwargs.get('cache')
+        # Called with the endpoint after every successful write
+        self.write_listeners = []
+
         self.url = url
         self.bearer_token = kwargs.get('bearer_token')
 
@@ -50,31 +85,215 @@ class Environment(object):
     def get_url(self, endpoint):
         return urljoin(self.url, '{}/{}'.format('api', endpoint))
 
-    def request(self, endpoint, data=None, patch=False):
+    def _should_retry(self, method, attempt, error=None, response=None):
+        if attempt >= self.max_retries:
+            return False
+
+        if response is not None:
+            # A 429 means the request was rejected before it was handled
+            return response.status_code == 429 or (
+                method == 'GET' and response.status_code in RETRY_STATUSES)
+
+        # Writes are only retried if they never reached the server
+        return method == 'GET' or isinstance(error, ConnectTimeout)
+
+    def _get_backoff(self, attempt, response=None):
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return min(int(retry_after), MAX_BACKOFF)
+
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(MAX_BACKOFF, self.backoff_factor * (2 ** attempt)))
+
+    def request(self, endpoint, data=None, patch=False, params=None, stream=False):
         url = self.get_url(endpoint)
-        self.session.headers.update(({'Referer': url}))
+        if params:
+            url = '{}?{}'.format(url, urlencode(params))
+        # Per-request headers leave the shared session untouched, so the
+        # same environment can be used from several threads at once
+        headers = {'Referer': url}
 
         if data:
-            if patch:
-                response = self.session.patch(url, json=data, timeout=5)
-            else:
-                response = self.session.post(url, json=data, timeout=5)
+            method = 'PATCH' if patch else 'POST'
         else:
-            response = self.session.get(url, timeout=5)
+            method = 'GET'
+            data = None
+
+        cached = None
+        if self.cache and method == 'GET':
+            cached = self.cache.get(url, self.bearer_token)
+            if cached:
+                headers.update(cached.validation_headers)
+
+        attempt = 0
+        while True:
+            response = None
+            start = time.perf_counter()
+            try:
+                response = self.session.request(
+                    method, url, json=data, headers=headers, timeout=self.timeout, stream=stream)
+            except (ConnectionError, Timeout) as err:
+                timings.record_request('balrog', time.perf_counter() - start)
+                if not self._should_retry(method, attempt, error=err):
+                    raise
+            else:
+                timings.record_request(
+                    'balrog', time.perf_counter() - start,
+                    bytes_sent=len(response.request.body or b''),
+                    bytes_received=(
+                        int(response.headers.get('Content-Length') or 0) if stream
+                        else len(response.content)))
+                if (response.status_code not in RETRY_STATUSES
+                        or not self._should_retry(method, attempt, response=response)):
+                    break
+
+            time.sleep(self._get_backoff(attempt, response=response))
+            attempt += 1
+
+        if cached and response.status_code == 304:
+            return cached.to_response(request=response.request)
 
         response.raise_for_status()
 
+        if self.cache:
+            if method == 'GET':
+                if stream:
+                    self._cache_stream(url, endpoint, response)
+                else:
+                    self.cache.put(url, self.bearer_token, endpoint, response)
+            else:
+                self.cache.invalidate(endpoint)
+
+        if method != 'GET':
+            for listener in self.write_listeners:
+                listener(endpoint)
+
         return response
 
+    def _cache_stream(self, url, endpoint, response):
+        """Copy a streamed body as it is read, and cache it once all of it has been."""
+        iter_content = response.iter_content
+
+        def iter_and_cache(chunk_size=1):
+            body = []
+            for chunk in iter_content(chunk_size):
+                body.append(chunk)
+                yield chunk
+            self.cache.put(url, self.bearer_token, endpoint, response, body=b''.join(body))
+
+        response.iter_content = iter_and_cache
+
     def fetch(self, endpoint, **kwargs):
         response = self.request(endpoint, **kwargs)
         return response.json()
 
     def validate(self):
-        response = self.request('rules')
+        # The current user is the cheapest authenticated resource, but older
+        # servers don't have it so fall back to listing the rules
+        try:
+            response = self.request('users/current')
+        except HTTPError as err:
+            if err.response.status_code != 404:
+                raise
+            response = self.request('rules')
         return response.status_code == 200 and response.headers['content-type']
 
     def save(self, path):
         os.makedirs(os.path.dirname(path), exist_ok=True)
         with open(path, 'w') as f:
             f.write(self.url)
+
+
+class RateLimiter(object):
+    """Token bucket allowing `rate` operations a second, in bursts of up to `burst`."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token and return how many seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0, -self._tokens / self.rate)
+
+    def wait(self):
+        time.sleep(self.reserve())
+
+
+class AsyncEnvironment(object):
+    """Coroutine counterpart to `Environment` for fanning out many requests.
+
+    Requests go through the wrapped environment, so they share its
+    connection pool, timeouts and retries, and at most `concurrency` of
+    them are in flight at once. An optional `RateLimiter` also caps how
+    quickly they are started.
+    """
+
+    def __init__(self, environment, concurrency=DEFAULT_POOL_SIZE, rate_limiter=None):
+        self.environment = environment
+        self.concurrency = concurrency
+        self.rate_limiter = rate_limiter
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    async def request(self, endpoint, **kwargs):
+        if self.rate_limiter:
+            await asyncio.sleep(self.rate_limiter.reserve())
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(self.environment.request, endpoint, **kwargs))
+
+    async def fetch(self, endpoint, **kwargs):
+        response = await self.request(endpoint, **kwargs)
+        return response.json()
+
+    async def fetch_rules(self, rule_ids, mappings=False):
+        """Fetch rules by id and, optionally, the release each one maps to.
+
+        Returns a dict of rules by id and a dict of releases by name. Each
+        mapped release is only fetched once however many rules share it.
+        """
+        rules = await asyncio.gather(*[self.fetch(f'rules/{rule_id}') for rule_id in rule_ids])
+        rules = dict(zip(rule_ids, rules))
+
+        releases = {}
+        if mappings:
+            names = sorted({rule['mapping'] for rule in rules.values()})
+            fetched = await asyncio.gather(*[self.fetch(f'releases/{name}') for name in names])
+            releases = dict(zip(names, fetched))
+
+        return rules, releases
+
+    async def fetch_releases(self, names, expand=False):
+        """Fetch releases by name, optionally adding the members of superblobs.
+
+        Returns a dict of releases by name, fetching each release once.
+        """
+        releases = {}
+        while names:
+            names = sorted(set(names) - set(releases))
+            fetched = await asyncio.gather(*[self.fetch(f'releases/{name}') for name in names])
+            releases.update(zip(names, fetched))
+
+            names = []
+            if expand:
+                for release in fetched:
+                    if release.get('schema_version') == 4000:
+                        names.extend(release.get('blobs', []))
+        return releases
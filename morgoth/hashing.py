@@ -0,0 +1,68 @@
+import hashlib
+
+
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_ALGORITHMS = ('sha512', 'sha256', 'md5')
+
+
+class Digest(object):
+    """Computes several digests and the total size of a stream in one pass.
+
+    A pickled or restored digest keeps its results but can no longer be
+    updated.
+    """
+
+    def __init__(self, algorithms=DEFAULT_ALGORITHMS):
+        self.algorithms = tuple(algorithms)
+        self.reset()
+
+    def __getstate__(self):
+        return {'algorithms': self.algorithms, 'size': self.size, 'hexdigests': self.hexdigests}
+
+    def __setstate__(self, state):
+        self.algorithms = state['algorithms']
+        self.size = state['size']
+        self._hashes = None
+        self._hexdigests = state['hexdigests']
+
+    @classmethod
+    def from_hexdigests(cls, hexdigests, size):
+        digest = cls.__new__(cls)
+        digest.__setstate__({'algorithms': tuple(hexdigests), 'size': size, 'hexdigests': hexdigests})
+        return digest
+
+    def reset(self):
+        self.size = 0
+        self._hashes = {algorithm: hashlib.new(algorithm) for algorithm in self.algorithms}
+        self._hexdigests = None
+
+    def update(self, chunk):
+        self.size += len(chunk)
+        for h in self._hashes.values():
+            h.update(chunk)
+
+    def hexdigest(self, algorithm):
+        if self._hashes is None:
+            return self._hexdigests[algorithm]
+        return self._hashes[algorithm].hexdigest()
+
+    @property
+    def hexdigests(self):
+        return {algorithm: self.hexdigest(algorithm) for algorithm in self.algorithms}
+
+
+def digest_stream(stream, algorithms=DEFAULT_ALGORITHMS, chunk_size=CHUNK_SIZE):
+    digest = Digest(algorithms)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    while True:
+        n = stream.readinto(buffer)
+        if not n:
+            break
+        digest.update(view[:n])
+    return digest
+
+
+def digest_file(path, algorithms=DEFAULT_ALGORITHMS, chunk_size=CHUNK_SIZE):
+    with open(path, 'rb') as f:
+        return digest_stream(f, algorithms=algorithms, chunk_size=chunk_size)
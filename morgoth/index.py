@@ -0,0 +1,218 @@
+import asyncio
+import json
+import os
+import sqlite3
+
+from contextlib import contextmanager
+
+from morgoth import CACHE_DIR
+from morgoth.environment import AsyncEnvironment
+from morgoth.hashing import CHUNK_SIZE
+from morgoth.utils import get_superblob_blobs, iter_json_array
+
+
+INDEX_PATH = os.path.join(CACHE_DIR, 'index.sqlite')
+
+
+class ReleaseIndex(object):
+    """A local index of the rules and releases for a product on Balrog.
+
+    Every release is indexed with the releases it ships, so superblobs
+    list their members and ordinary releases list themselves, along with
+    the version of each addon it contains. Syncing only fetches rules and
+    releases whose `data_version` has changed.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS rules (
+            rule_id INTEGER PRIMARY KEY,
+            channel TEXT,
+            version TEXT,
+            mapping TEXT,
+            data_version INTEGER,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS rules_mapping ON rules (mapping);
+        CREATE TABLE IF NOT EXISTS releases (
+            name TEXT PRIMARY KEY,
+            data_version INTEGER,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS members (
+            superblob TEXT NOT NULL,
+            release TEXT NOT NULL,
+            PRIMARY KEY (superblob, release)
+        );
+        CREATE INDEX IF NOT EXISTS members_release ON members (release);
+        CREATE TABLE IF NOT EXISTS addons (
+            release TEXT NOT NULL,
+            addon_id TEXT NOT NULL,
+            version TEXT,
+            PRIMARY KEY (release, addon_id)
+        );
+        CREATE INDEX IF NOT EXISTS addons_addon_id ON addons (addon_id, version);
+    """
+
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        self._initialized = False
+
+    @contextmanager
+    def _connect(self):
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=10)
+        try:
+            if not self._initialized:
+                connection.executescript(self.SCHEMA)
+                self._initialized = True
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get_meta(self, key):
+        with self._connect() as connection:
+            row = connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def clear(self):
+        with self._connect() as connection:
+            for table in ('meta', 'rules', 'releases', 'members', 'addons'):
+                connection.execute(f'DELETE FROM {table}')
+
+    def _get_data_versions(self, table, key):
+        with self._connect() as connection:
+            return dict(connection.execute(f'SELECT {key}, data_version FROM {table}'))
+
+    def sync(self, environment, product='SystemAddons', concurrency=None):
+        """Bring the index up to date with Balrog and return counts of what changed."""
+        if self.get_meta('url') != environment.url or self.get_meta('product') != product:
+            self.clear()
+
+        rules = [
+            rule for rule in environment.request('rules', params={'product': product}).json().get(
+                'rules', [])
+            if rule.get('product', product) == product
+        ]
+        indexed_rules = self._get_data_versions('rules', 'rule_id')
+        changed_rules = [
+            rule for rule in rules
+            if rule.get('data_version') is None
+            or indexed_rules.get(rule['rule_id']) != rule.get('data_version')
+        ]
+        removed_rules = set(indexed_rules) - {rule['rule_id'] for rule in rules}
+
+        response = environment.request('releases', params={'product': product}, stream=True)
+        listed = {
+            release['name']: release.get('data_version')
+            for release in iter_json_array(response.iter_content(CHUNK_SIZE), 'releases')
+            if release.get('product') == product
+        }
+        indexed_releases = self._get_data_versions('releases', 'name')
+        changed_names = sorted(
+            name for name, data_version in listed.items()
+            if data_version is None or indexed_releases.get(name) != data_version)
+        removed_releases = set(indexed_releases) - set(listed)
+
+        async def fetch_releases(async_environment):
+            return await asyncio.gather(*[
+                async_environment.fetch(f'releases/{name}') for name in changed_names])
+
+        with AsyncEnvironment(environment, concurrency=concurrency or environment.pool_size) as \
+                async_environment:
+            releases = asyncio.run(fetch_releases(async_environment))
+
+        with self._connect() as connection:
+            connection.executemany(
+                'DELETE FROM rules WHERE rule_id = ?', [(rule_id,) for rule_id in removed_rules])
+            connection.executemany(
+                'INSERT OR REPLACE INTO rules '
+                '(rule_id, channel, version, mapping, data_version, data) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [
+                    (rule['rule_id'], rule.get('channel'), rule.get('version'),
+                     rule.get('mapping'), rule.get('data_version'), json.dumps(rule))
+                    for rule in changed_rules
+                ])
+
+            for name in removed_releases.union(changed_names):
+                connection.execute('DELETE FROM releases WHERE name = ?', (name,))
+                connection.execute('DELETE FROM members WHERE superblob = ?', (name,))
+                connection.execute('DELETE FROM addons WHERE release = ?', (name,))
+
+            for name, release in zip(changed_names, releases):
+                connection.execute(
+                    'INSERT INTO releases (name, data_version, data) VALUES (?, ?, ?)',
+                    (name, listed[name], json.dumps(release)))
+                connection.executemany(
+                    'INSERT OR IGNORE INTO members (superblob, release) VALUES (?, ?)',
+                    [(name, member) for member in get_superblob_blobs(dict(release, name=name))])
+                connection.executemany(
+                    'INSERT OR IGNORE INTO addons (release, addon_id, version) VALUES (?, ?, ?)',
+                    [
+                        (name, addon_id, addon.get('version'))
+                        for addon_id, addon in release.get('addons', {}).items()
+                    ])
+
+            connection.executemany(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                [('url', environment.url), ('product', product)])
+
+        return {
+            'rules': len(rules),
+            'rules_updated': len(changed_rules),
+            'rules_removed': len(removed_rules),
+            'releases': len(listed),
+            'releases_updated': len(changed_names),
+            'releases_removed': len(removed_releases),
+        }
+
+    def dump(self):
+        """Return every indexed rule and release, and the releases' data versions."""
+        with self._connect() as connection:
+            rules = [json.loads(row[0]) for row in connection.execute(
+                'SELECT data FROM rules ORDER BY rule_id')]
+            releases = {}
+            data_versions = {}
+            for name, data_version, data in connection.execute(
+                    'SELECT name, data_version, data FROM releases ORDER BY name'):
+                releases[name] = json.loads(data)
+                data_versions[name] = data_version
+        return rules, releases, data_versions
+
+    def find_addon(self, addon_id, version=None):
+        """Return the releases shipping an addon and the rules mapped to them.
+
+        Each result is a dict of the release, the addon version and a list
+        of the rules whose mapping ships that release.
+        """
+        query = 'SELECT release, version FROM addons WHERE addon_id = ?'
+        params = [addon_id]
+        if version is not None:
+            query += ' AND version = ?'
+            params.append(version)
+
+        with self._connect() as connection:
+            results = []
+            for release, addon_version in connection.execute(query + ' ORDER BY release', params):
+                rules = connection.execute(
+                    'SELECT DISTINCT rules.data FROM rules '
+                    'JOIN members ON rules.mapping = members.superblob '
+                    'WHERE members.release = ? ORDER BY rules.rule_id', (release,)).fetchall()
+                results.append({
+                    'release': release,
+                    'version': addon_version,
+                    'rules': [json.loads(row[0]) for row in rules],
+                })
+        return results
+
+    def find_rules(self, mapping):
+        with self._connect() as connection:
+            rows = connection.execute(
+                'SELECT data FROM rules WHERE mapping = ? ORDER BY rule_id', (mapping,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
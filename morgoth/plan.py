@@ -0,0 +1,64 @@
+import json
+import time
+
+from morgoth.utils import get_modified_superblobs
+
+
+PLAN_VERSION = 1
+
+
+class PlanError(Exception):
+    pass
+
+
+def build_rules_plan(rules, releases, release_names, adds, removes, balrog_url):
+    """Work out every release to create and rule to remap for a set of changes.
+
+    `rules` maps rule ids to rules and `releases` maps their mappings to
+    the releases themselves. Releases that several rules need are only
+    created once.
+    """
+    superblobs = get_modified_superblobs(releases, adds, removes)
+
+    new_releases = {}
+    rule_changes = []
+    for rule_id, rule in rules.items():
+        superblob = superblobs[rule['mapping']]
+
+        if superblob['name'] not in release_names:
+            new_releases[superblob['name']] = superblob
+
+        if superblob['name'] != rule['mapping']:
+            rule_changes.append({
+                'rule_id': rule_id,
+                'from': rule['mapping'],
+                'to': superblob['name'],
+                'rule': dict(rule, mapping=superblob['name']),
+            })
+
+    return {
+        'version': PLAN_VERSION,
+        'balrog_url': balrog_url,
+        'created': time.time(),
+        'adds': list(adds),
+        'removes': list(removes),
+        'releases': [new_releases[name] for name in sorted(new_releases)],
+        'rule_changes': rule_changes,
+    }
+
+
+def save_plan(plan, path):
+    with open(path, 'w') as f:
+        f.write(json.dumps(plan, indent=2, sort_keys=True))
+
+
+def load_plan(path):
+    try:
+        with open(path, 'r') as f:
+            plan = json.load(f)
+    except (OSError, ValueError) as err:
+        raise PlanError('Unable to read plan: {}'.format(err))
+
+    if plan.get('version') != PLAN_VERSION:
+        raise PlanError('Unsupported plan version: {}'.format(plan.get('version')))
+    return plan
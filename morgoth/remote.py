@@ -0,0 +1,186 @@
+import io
+import random
+import re
+import time
+
+import requests
+
+from requests.exceptions import ChunkedEncodingError, ConnectionError, Timeout
+
+from morgoth.hashing import CHUNK_SIZE, Digest
+
+
+MAX_RETRIES = 5
+TIMEOUT = (5, 30)
+BACKOFF_FACTOR = 0.5
+MAX_BACKOFF = 10
+
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-\d+/(\d+|\*)')
+
+
+READ_AHEAD_SIZE = 64 * 1024
+
+
+class IncompleteDownload(Exception):
+    pass
+
+
+class RangeRequestsNotSupported(Exception):
+    pass
+
+
+class RangeFile(io.RawIOBase):
+    """A read-only, seekable file backed by HTTP Range requests.
+
+    This is enough for `zipfile` to read the central directory and
+    individual members of a remote archive without downloading all of it.
+    Reads are rounded up to `READ_AHEAD_SIZE` and the last block fetched is
+    kept, so the many small reads zipfile makes cost few round trips.
+    """
+
+    def __init__(self, url, session=None):
+        self.session = session or requests.Session()
+
+        response = self.session.head(url, allow_redirects=True, timeout=TIMEOUT)
+        response.raise_for_status()
+        if (response.headers.get('Accept-Ranges') != 'bytes'
+                or 'Content-Length' not in response.headers
+                or response.headers.get('Content-Encoding')):
+            raise RangeRequestsNotSupported()
+
+        self.url = response.url
+        self.size = int(response.headers['Content-Length'])
+        self._position = 0
+        self._block_start = 0
+        self._block = b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError('Invalid whence ({})'.format(whence))
+
+        if position < 0:
+            raise ValueError('Negative seek position {}'.format(position))
+        self._position = position
+        return position
+
+    def _fetch(self, start, end):
+        response = self.session.get(
+            self.url, headers={'Range': f'bytes={start}-{end - 1}'}, timeout=TIMEOUT)
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise RangeRequestsNotSupported()
+        return response.content
+
+    def read(self, size=-1):
+        start = self._position
+        if size is None or size < 0:
+            end = self.size
+        else:
+            end = min(start + size, self.size)
+        if start >= end:
+            return b''
+
+        block_end = self._block_start + len(self._block)
+        if not (self._block_start <= start and end <= block_end):
+            if end > self.size - READ_AHEAD_SIZE:
+                # zipfile reads the archive from the end, so grab the whole tail
+                fetch_start = max(0, min(start, self.size - READ_AHEAD_SIZE))
+                fetch_end = self.size
+            else:
+                fetch_start = start
+                fetch_end = min(max(end, start + READ_AHEAD_SIZE), self.size)
+            self._block = self._fetch(fetch_start, fetch_end)
+            self._block_start = fetch_start
+
+        offset = start - self._block_start
+        data = self._block[offset:offset + end - start]
+        self._position += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+def _expected_size(response, offset):
+    """Return the total size of the file being downloaded, if the server told us."""
+    if response.status_code == 206:
+        match = CONTENT_RANGE_RE.match(response.headers.get('Content-Range', ''))
+        if not match or int(match.group(1)) != offset:
+            return None
+        total = match.group(2)
+        return int(total) if total != '*' else None
+    length = response.headers.get('Content-Length')
+    return int(length) if length else None
+
+
+def download(url, fileobj=None, digest=None, session=None, retries=MAX_RETRIES,
+             chunk_size=CHUNK_SIZE):
+    """Stream `url` into `fileobj`, hashing the chunks as they are written.
+
+    If the connection drops part of the way through, the download is
+    resumed with a Range request. If the server ignores the Range header,
+    or answers with a range we did not ask for, the download starts over
+    from the beginning. Without a `fileobj` the body is only hashed.
+    """
+    if digest is None:
+        digest = Digest()
+    session = session or requests.Session()
+
+    offset = 0
+    attempt = 0
+    while True:
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+                response.raise_for_status()
+
+                expected_size = _expected_size(response, offset)
+                if offset and (response.status_code != 206 or expected_size is None):
+                    # The server did not honour the range, so start again
+                    if fileobj is not None:
+                        fileobj.seek(0)
+                        fileobj.truncate()
+                    digest.reset()
+                    offset = 0
+                    if response.status_code == 206:
+                        # Only part of the file, and not the part we asked
+                        # for, so ask again for all of it
+                        raise IncompleteDownload()
+                    expected_size = _expected_size(response, offset)
+
+                for chunk in response.iter_content(chunk_size):
+                    if fileobj is not None:
+                        fileobj.write(chunk)
+                    digest.update(chunk)
+                    offset += len(chunk)
+
+                if expected_size is not None and offset < expected_size:
+                    raise IncompleteDownload()
+        except (ChunkedEncodingError, ConnectionError, IncompleteDownload, Timeout):
+            attempt += 1
+            if attempt > retries:
+                raise
+            # Exponential backoff with full jitter
+            time.sleep(random.uniform(0, min(MAX_BACKOFF, BACKOFF_FACTOR * (2 ** attempt))))
+            continue
+
+        if fileobj is not None:
+            fileobj.flush()
+        return digest
@@ -0,0 +1,280 @@
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from hashlib import md5, sha256
+
+from botocore.exceptions import ClientError
+
+from morgoth import CACHE_DIR
+from morgoth.utils import validate_uploaded_xpi_hash
+
+
+MB = 1024 * 1024
+
+LISTING_CACHE_DIR = os.path.join(CACHE_DIR, 's3')
+UPLOAD_STATE_DIR = os.path.join(CACHE_DIR, 'uploads')
+
+DEFAULT_MULTIPART_THRESHOLD = 8 * MB
+DEFAULT_MULTIPART_CHUNKSIZE = 8 * MB
+DEFAULT_MAX_CONCURRENCY = 10
+
+
+class BucketListing(object):
+    """The set of keys under a prefix of an S3 bucket.
+
+    When `ttl` is positive the listing is cached on disk for that many
+    seconds. Uploads recorded with `add` are written through to the cache
+    so it never hides our own files, but other people's uploads can be
+    missing from it, so `refresh` before trusting it with a write.
+    """
+
+    def __init__(self, bucket, prefix, ttl=0, cache_dir=LISTING_CACHE_DIR):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self._keys = None
+        self._cached = False
+
+    @property
+    def cache_path(self):
+        cache_key = sha256('{}/{}'.format(self.bucket.name, self.prefix).encode()).hexdigest()
+        return os.path.join(self.cache_dir, '{}.json'.format(cache_key))
+
+    @property
+    def keys(self):
+        if self._keys is None:
+            self._keys = self._load_cache()
+            self._cached = self._keys is not None
+        if self._keys is None:
+            self._list()
+        return self._keys
+
+    def _list(self):
+        self._keys = {obj.key for obj in self.bucket.objects.filter(Prefix=self.prefix)}
+        self._cached = False
+        self._save_cache()
+
+    def refresh(self):
+        """List the keys again if they came from the disk cache, and return whether they did."""
+        if not self._cached:
+            return False
+        self._list()
+        return True
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def _load_cache(self):
+        if self.ttl <= 0:
+            return None
+
+        try:
+            with open(self.cache_path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - data.get('timestamp', 0) > self.ttl:
+            return None
+        return set(data.get('keys', []))
+
+    def _save_cache(self):
+        if self.ttl <= 0:
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'timestamp': time.time(), 'keys': sorted(self._keys)}, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def add(self, key):
+        self.keys.add(key)
+        self._save_cache()
+
+    def get_suffixes(self, xpi, prefix, reserved=()):
+        """Return the suffixes this XPI has already been uploaded with, in order.
+
+        Keys in `reserved` are treated as if they were in the listing.
+        """
+        pattern = re.compile(r'{}(-\d+)?\.xpi$'.format(re.escape(xpi.get_ftp_path(prefix)[:-4])))
+        keys = self.keys.union(reserved)
+        suffixes = [m.group(1) or '' for m in map(pattern.match, keys) if m]
+        return sorted(suffixes, key=lambda suffix: int(suffix[1:]) if suffix else 1)
+
+    def get_free_suffix(self, xpi, prefix, reserved=()):
+        used = set(self.get_suffixes(xpi, prefix, reserved=reserved))
+        index = 2
+        while '-{}'.format(index) in used:
+            index += 1
+        return '-{}'.format(index)
+
+
+class BucketPool(object):
+    """Gives each thread its own Bucket resource, all created from one session.
+
+    boto3 resources are not thread safe, but creating one per task would
+    mean a new client and connection pool each time.
+    """
+
+    def __init__(self, session, bucket_name):
+        self.session = session
+        self.bucket_name = bucket_name
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def get(self):
+        bucket = getattr(self._local, 'bucket', None)
+        if bucket is None:
+            # Sessions are not thread safe either, so serialize resource creation
+            with self._lock:
+                bucket = self.session.resource('s3').Bucket(self.bucket_name)
+            self._local.bucket = bucket
+        return bucket
+
+
+def find_uploaded_suffix(xpi, bucket, listing, prefix, known_keys=()):
+    """Return the suffix this XPI was already uploaded with, or None.
+
+    Suffixes for `known_keys`, where we remember uploading this file to,
+    are checked first.
+    """
+    suffixes = listing.get_suffixes(xpi, prefix)
+    suffixes.sort(key=lambda suffix: xpi.get_ftp_path(prefix, suffix=suffix) not in known_keys)
+    for suffix in suffixes:
+        if validate_uploaded_xpi_hash(xpi, bucket, xpi.get_ftp_path(prefix, suffix=suffix)):
+            return suffix
+    return None
+
+
+class MultipartUpload(object):
+    """Uploads a file to S3 in parts from a pool of threads.
+
+    The upload id is remembered on disk until the upload completes, so a
+    later attempt for the same key and file hash picks up the parts that
+    were already uploaded instead of starting over.
+    """
+
+    def __init__(self, bucket, key, path, file_hash, metadata=None,
+                 chunksize=DEFAULT_MULTIPART_CHUNKSIZE, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 state_dir=UPLOAD_STATE_DIR):
+        self.client = bucket.meta.client
+        self.bucket_name = bucket.name
+        self.key = key
+        self.path = path
+        self.file_hash = file_hash
+        self.metadata = metadata or {}
+        self.chunksize = chunksize
+        self.max_concurrency = max_concurrency
+        self.state_dir = state_dir
+
+    @property
+    def state_path(self):
+        state_key = sha256('{}/{}:{}'.format(self.bucket_name, self.key, self.file_hash).encode())
+        return os.path.join(self.state_dir, '{}.json'.format(state_key.hexdigest()))
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_state(self, upload_id):
+        os.makedirs(self.state_dir, exist_ok=True)
+        with open(self.state_path, 'w') as f:
+            json.dump({'upload_id': upload_id, 'chunksize': self.chunksize}, f)
+
+    def _clear_state(self):
+        try:
+            os.remove(self.state_path)
+        except FileNotFoundError:
+            pass
+
+    def _get_uploaded_parts(self, upload_id):
+        parts = {}
+        paginator = self.client.get_paginator('list_parts')
+        try:
+            for page in paginator.paginate(Bucket=self.bucket_name, Key=self.key, UploadId=upload_id):
+                for part in page.get('Parts', []):
+                    parts[part['PartNumber']] = part['ETag']
+        except ClientError as err:
+            if err.response.get('Error', {}).get('Code') == 'NoSuchUpload':
+                return None
+            raise
+        return parts
+
+    def _resume(self):
+        state = self._load_state()
+        if not state or state.get('chunksize') != self.chunksize:
+            return None, {}
+
+        parts = self._get_uploaded_parts(state['upload_id'])
+        if parts is None:
+            return None, {}
+        return state['upload_id'], parts
+
+    def _upload_part(self, upload_id, part_number, uploaded_etag):
+        with open(self.path, 'rb') as f:
+            f.seek((part_number - 1) * self.chunksize)
+            data = f.read(self.chunksize)
+
+        etag = '"{}"'.format(md5(data).hexdigest())
+        if etag != uploaded_etag:
+            response = self.client.upload_part(
+                Bucket=self.bucket_name, Key=self.key, UploadId=upload_id,
+                PartNumber=part_number, Body=data)
+            etag = response['ETag']
+
+        return part_number, etag, len(data)
+
+    def upload(self, progress=None):
+        upload_id, uploaded_parts = self._resume()
+        if upload_id is None:
+            response = self.client.create_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key, Metadata=self.metadata)
+            upload_id = response['UploadId']
+            self._save_state(upload_id)
+
+        part_count = max(1, math.ceil(os.path.getsize(self.path) / self.chunksize))
+        etags = {}
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = [
+                executor.submit(self._upload_part, upload_id, part_number, uploaded_parts.get(part_number))
+                for part_number in range(1, part_count + 1)
+            ]
+            for future in as_completed(futures):
+                part_number, etag, length = future.result()
+                etags[part_number] = etag
+                if progress:
+                    progress(length)
+
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket_name, Key=self.key, UploadId=upload_id,
+            MultipartUpload={
+                'Parts': [{'ETag': etags[n], 'PartNumber': n} for n in sorted(etags)],
+            })
+        self._clear_state()
+
+
+def upload_file(bucket, key, path, file_hash, metadata=None,
+                multipart_threshold=DEFAULT_MULTIPART_THRESHOLD,
+                multipart_chunksize=DEFAULT_MULTIPART_CHUNKSIZE,
+                max_concurrency=DEFAULT_MAX_CONCURRENCY, progress=None):
+    size = os.path.getsize(path)
+    if size < multipart_threshold:
+        with open(path, 'rb') as data:
+            bucket.put_object(Key=key, Body=data, Metadata=metadata or {})
+        if progress:
+            progress(size)
+    else:
+        MultipartUpload(
+            bucket, key, path, file_hash, metadata=metadata, chunksize=multipart_chunksize,
+            max_concurrency=max_concurrency).upload(progress=progress)
@@ -4,12 +4,35 @@ from morgoth import CONFIG_PATH
 
 
 class Settings(object):
+    """Configuration stored in an INI file.
+
+    The file is only read the first time the configuration is used, so
+    importing this module does no I/O.
+    """
     _path = None
+    _config = None
 
     def __init__(self, path):
-        self.config = configparser.ConfigParser()
         self.path = path
 
+    @property
+    def config(self):
+        if self._config is None:
+            self._config = configparser.ConfigParser()
+            self._read()
+        return self._config
+
+    def _read(self):
+        if not self._path:
+            return
+
+        try:
+            with open(self._path, 'a+') as f:
+                f.seek(0)
+                self._config.read_file(f)
+        except FileNotFoundError:
+            self._path = None
+
     @property
     def path(self):
         return self._path
@@ -18,9 +41,8 @@ class Settings(object):
     def path(self, value):
         if value != self._path:
             self._path = value
-            with open(self._path, 'a+') as f:
-                f.seek(0)
-                self.config.read_file(f)
+            if self._config is not None:
+                self._read()
 
     @staticmethod
     def _parse_key(key):
@@ -60,7 +82,4 @@ class Settings(object):
             self.config.write(f)
 
 
-try:
-    settings = Settings(CONFIG_PATH)
-except FileNotFoundError:
-    settings = Settings(None)
+settings = Settings(CONFIG_PATH)
@@ -0,0 +1,103 @@
+import copy
+import threading
+
+from collections import Counter
+
+
+class SessionCache(object):
+    """Objects and responses kept between the commands of a shell session.
+
+    Values are stored by kind and key. Writes made through an environment
+    the cache is watching drop every kind of value they could change.
+    Hits are counted per value, so they are also the number of fetches saved.
+    """
+
+    # The kinds of value each top level endpoint can change
+    INVALIDATES = {
+        'releases': ('release names', 'releases'),
+        'rules': ('rules',),
+        # Scheduled changes are enacted a few seconds after they are posted
+        'scheduled_changes': ('rules',),
+    }
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+        self.hits = Counter()
+        self.misses = Counter()
+        self.invalidations = Counter()
+
+    def get(self, kind, key, factory):
+        """Return the value for a key, calling `factory` to create it if needed."""
+        with self._lock:
+            if (kind, key) in self._values:
+                self.hits[kind] += 1
+                return self._values[(kind, key)]
+
+        value = factory()
+        with self._lock:
+            self.misses[kind] += 1
+            self._values[(kind, key)] = value
+        return value
+
+    def get_many(self, kind, keys, factory):
+        """Return a dict of copies of the values for some keys.
+
+        `factory` is called once with the list of missing keys and has to
+        return a dict of their values. Copies are returned so callers are
+        free to modify them.
+        """
+        values = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                if (kind, key) in self._values:
+                    values[key] = self._values[(kind, key)]
+                    self.hits[kind] += 1
+                elif key not in missing:
+                    missing.append(key)
+
+        if missing:
+            fetched = factory(missing)
+            with self._lock:
+                for key, value in fetched.items():
+                    self._values[(kind, key)] = value
+                    self.misses[kind] += 1
+            values.update(fetched)
+
+        return copy.deepcopy(values)
+
+    def invalidate(self, *kinds):
+        with self._lock:
+            for kind, key in list(self._values):
+                if kind in kinds:
+                    del self._values[(kind, key)]
+                    self.invalidations[kind] += 1
+
+    def on_write(self, endpoint):
+        self.invalidate(*self.INVALIDATES.get(endpoint.split('/')[0], ()))
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def get_stats(self):
+        """Return a list of `(kind, entries, hits, misses, invalidations)` tuples."""
+        with self._lock:
+            entries = Counter(kind for kind, key in self._values)
+            kinds = set(entries) | set(self.hits) | set(self.misses)
+            return [
+                (kind, entries[kind], self.hits[kind], self.misses[kind], self.invalidations[kind])
+                for kind in sorted(kinds)
+            ]
+
+    def format_table(self):
+        stats = self.get_stats()
+        lines = ['{:<16} {:>8} {:>8} {:>8} {:>12}'.format(
+            'Cache', 'Entries', 'Hits', 'Misses', 'Invalidated')]
+        for kind, entries, hits, misses, invalidations in stats:
+            lines.append('{:<16} {:>8} {:>8} {:>8} {:>12}'.format(
+                kind, entries, hits, misses, invalidations))
+        lines.append('')
+        lines.append('Round trips saved: {}'.format(sum(row[2] for row in stats)))
+        return '\n'.join(lines)
@@ -0,0 +1,119 @@
+import gzip
+import json
+import time
+
+import requests
+
+from requests.exceptions import HTTPError
+from urllib.parse import urlencode, urljoin
+
+from morgoth.environment import DEFAULT_POOL_SIZE
+
+
+SNAPSHOT_VERSION = 1
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class Snapshot(object):
+    """The rules and releases for a product on Balrog at one point in time."""
+
+    def __init__(self, balrog_url, product, rules, releases, data_versions, created=None):
+        self.balrog_url = balrog_url
+        self.product = product
+        self.rules = {str(rule['rule_id']): rule for rule in rules}
+        self.releases = releases
+        self.data_versions = data_versions
+        self.created = created or time.time()
+
+    @classmethod
+    def from_index(cls, index):
+        rules, releases, data_versions = index.dump()
+        return cls(index.get_meta('url'), index.get_meta('product'), rules, releases,
+                   data_versions)
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with gzip.open(path, 'rt') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as err:
+            raise SnapshotError('Unable to read snapshot: {}'.format(err))
+
+        if data.get('version') != SNAPSHOT_VERSION:
+            raise SnapshotError('Unsupported snapshot version: {}'.format(data.get('version')))
+        return cls(
+            data['balrog_url'], data['product'], data['rules'], data['releases'],
+            data['data_versions'], created=data['created'])
+
+    def save(self, path):
+        with gzip.open(path, 'wt') as f:
+            f.write(json.dumps({
+                'version': SNAPSHOT_VERSION,
+                'balrog_url': self.balrog_url,
+                'product': self.product,
+                'created': self.created,
+                'rules': list(self.rules.values()),
+                'releases': self.releases,
+                'data_versions': self.data_versions,
+            }))
+
+
+class SnapshotEnvironment(object):
+    """A read-only stand-in for `Environment` that answers from a snapshot.
+
+    Only the endpoints the commands read are supported, and every write
+    raises `SnapshotError`.
+    """
+    pool_size = DEFAULT_POOL_SIZE
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.url = snapshot.balrog_url
+        self.write_listeners = []
+
+    def get_url(self, endpoint):
+        return urljoin(self.url, '{}/{}'.format('api', endpoint))
+
+    def _get(self, endpoint):
+        snapshot = self.snapshot
+        if endpoint == 'rules':
+            rules = list(snapshot.rules.values())
+            return {'count': len(rules), 'rules': rules}
+        if endpoint == 'releases':
+            return {'releases': [
+                {'name': name, 'product': snapshot.product, 'data_version': data_version}
+                for name, data_version in snapshot.data_versions.items()
+            ]}
+        if endpoint.startswith('rules/'):
+            return snapshot.rules.get(endpoint[len('rules/'):])
+        if endpoint.startswith('releases/'):
+            return snapshot.releases.get(endpoint[len('releases/'):])
+        return None
+
+    def request(self, endpoint, data=None, patch=False, params=None, stream=False):
+        if data:
+            raise SnapshotError('Snapshots are read-only.')
+
+        url = self.get_url(endpoint)
+        if params:
+            url = '{}?{}'.format(url, urlencode(params))
+
+        body = self._get(endpoint)
+        response = requests.Response()
+        response.url = url
+        response.headers['Content-Type'] = 'application/json'
+        response.encoding = 'utf-8'
+        response.status_code = 404 if body is None else 200
+        response._content = json.dumps(body or {}).encode()
+        response._content_consumed = True
+        if body is None:
+            raise HTTPError('404 Client Error: Not found in snapshot: {}'.format(url),
+                            response=response)
+        return response
+
+    def fetch(self, endpoint, **kwargs):
+        response = self.request(endpoint, **kwargs)
+        return response.json()
@@ -0,0 +1,115 @@
+import json
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Timings(object):
+    """Collects how long each phase of a command took and what it sent over the network.
+
+    Phases with the same name are added together. Requests are grouped by
+    service, such as `balrog` or `s3`. Nothing is recorded until `enabled`
+    is set.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.phases = OrderedDict()
+        self.requests = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                phase = self.phases.setdefault(name, {'count': 0, 'seconds': 0.0})
+                phase['count'] += 1
+                phase['seconds'] += elapsed
+
+    def record_request(self, service, seconds, bytes_sent=0, bytes_received=0):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            stats = self.requests.setdefault(service, {
+                'count': 0,
+                'seconds': 0.0,
+                'max_seconds': 0.0,
+                'bytes_sent': 0,
+                'bytes_received': 0,
+            })
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['bytes_sent'] += bytes_sent
+            stats['bytes_received'] += bytes_received
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'phases': json.loads(json.dumps(self.phases)),
+                'requests': json.loads(json.dumps(self.requests)),
+            }
+
+    def format_table(self):
+        lines = ['{:<32} {:>6} {:>10}'.format('Phase', 'Count', 'Seconds')]
+        for name, phase in self.phases.items():
+            lines.append('{:<32} {:>6} {:>10.3f}'.format(name, phase['count'], phase['seconds']))
+
+        if self.requests:
+            lines.append('')
+            lines.append('{:<10} {:>8} {:>10} {:>10} {:>10} {:>12} {:>12}'.format(
+                'Service', 'Requests', 'Seconds', 'Mean ms', 'Max ms', 'Sent', 'Received'))
+            for service, stats in self.requests.items():
+                lines.append('{:<10} {:>8} {:>10.3f} {:>10.1f} {:>10.1f} {:>12} {:>12}'.format(
+                    service, stats['count'], stats['seconds'],
+                    stats['seconds'] / stats['count'] * 1000, stats['max_seconds'] * 1000,
+                    stats['bytes_sent'], stats['bytes_received']))
+
+        return '\n'.join(lines)
+
+
+def _get_body_size(body):
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    if hasattr(body, 'seek') and hasattr(body, 'tell'):
+        position = body.tell()
+        size = body.seek(0, 2) - position
+        body.seek(position)
+        return size
+    return 0
+
+
+def instrument_boto3_session(session):
+    """Record every S3 call made through clients of `session`."""
+
+    def before_call(params, context, **kwargs):
+        if not timings.enabled:
+            return
+        context['morgoth_start'] = time.perf_counter()
+        context['morgoth_bytes_sent'] = _get_body_size(params.get('body'))
+
+    def after_call(http_response, context, **kwargs):
+        start = context.get('morgoth_start')
+        if start is None:
+            return
+        received = int(http_response.headers.get('Content-Length') or 0)
+        timings.record_request(
+            's3', time.perf_counter() - start,
+            bytes_sent=context.get('morgoth_bytes_sent', 0), bytes_received=received)
+
+    session.events.register('before-call.s3', before_call)
+    session.events.register('after-call.s3', after_call)
+
+
+timings = Timings()
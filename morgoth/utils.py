@@ -1,9 +1,20 @@
-import os
-import tempfile
+import codecs
+import itertools
+import json
+import re
+
+from hashlib import sha256
 
 from colorama import Style
 
-from morgoth.xpi import XPI
+from morgoth.hashing import CHUNK_SIZE, Digest
+
+
+SHA512_METADATA_KEY = 'sha512'
+NO_UPDATE_RELEASE = 'SystemAddons-no-update'
+
+WHITESPACE_RE = re.compile(r'[\s,]*')
+COLON_RE = re.compile(r'\s*:?\s*')
 
 
 def output(str, *styles):
@@ -14,9 +25,164 @@ def output(str, *styles):
     print(Style.RESET_ALL)
 
 
+def iter_json_array(chunks, key):
+    """Yield the items of the array under `key` in a JSON object, as it streams in.
+
+    Only one item is held in memory at a time. The items are expected to
+    be objects, as a number split across two chunks would be misread. The
+    rest of the chunks are read once the array ends, so a streamed
+    response is consumed completely.
+    """
+    decoder = json.JSONDecoder()
+    decode = codecs.getincrementaldecoder('utf-8')().decode
+    start_re = re.compile(r'"{}"\s*:\s*\['.format(re.escape(key)))
+
+    buffer = ''
+    in_array = False
+    for chunk in chunks:
+        buffer += decode(chunk)
+
+        position = 0
+        if not in_array:
+            match = start_re.search(buffer)
+            if not match:
+                continue
+            in_array = True
+            position = match.end()
+
+        while True:
+            position = WHITESPACE_RE.match(buffer, position).end()
+            if buffer.startswith(']', position):
+                for chunk in chunks:
+                    pass
+                return
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # The rest of this item has not arrived yet
+                break
+            yield item
+
+        buffer = buffer[position:]
+
+
+def get_json_member(chunks, key, default=None):
+    """Return one member of a JSON object, reading only as far as it.
+
+    Members are decoded one at a time, and nothing after the wanted
+    member is read.
+    """
+    decoder = json.JSONDecoder()
+    decode = codecs.getincrementaldecoder('utf-8')().decode
+
+    buffer = ''
+    position = None
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        buffer += decode(chunk or b'', final)
+
+        if position is None:
+            start = buffer.find('{')
+            if start == -1:
+                continue
+            position = start + 1
+
+        while True:
+            position = WHITESPACE_RE.match(buffer, position).end()
+            if buffer.startswith('}', position):
+                return default
+            try:
+                name, end = decoder.raw_decode(buffer, position)
+                end = COLON_RE.match(buffer, end).end()
+                value, end = decoder.raw_decode(buffer, end)
+            except ValueError:
+                # The rest of this member has not arrived yet
+                break
+            if end == len(buffer) and not final:
+                # A number could carry on into the next chunk
+                break
+            if name == key:
+                return value
+            position = end
+
+        buffer = buffer[position:]
+        position = 0
+
+    return default
+
+
+def read_release_name(path, chunk_size=64 * 1024):
+    with open(path, 'rb') as f:
+        return get_json_member(iter(lambda: f.read(chunk_size), b''), 'name')
+
+
+def get_superblob_data(names):
+    names = sorted(names)
+    names_hash = sha256('-'.join(names).encode()).hexdigest()
+    return {
+        'blobs': names,
+        'name': 'Superblob-{}'.format(names_hash),
+        'schema_version': 4000,
+    }
+
+
+def get_superblob_blobs(release):
+    """Return the names of the releases shipped by a rule's mapping."""
+    if release.get('schema_version') == 4000:
+        return list(release.get('blobs', []))
+    if release.get('schema_version') == 5000:
+        return [release['name']]
+    return []
+
+
+def get_modified_superblob(release, adds, removes):
+    """Return the superblob for `release` with some releases added and removed."""
+    blobs = get_superblob_blobs(release)
+    for add in adds:
+        if add and add not in blobs:
+            blobs.append(add)
+    for remove in removes:
+        if remove in blobs:
+            blobs.remove(remove)
+
+    if not blobs:
+        return {'blobs': [], 'name': NO_UPDATE_RELEASE, 'schema_version': 4000}
+    return get_superblob_data(blobs)
+
+
+def get_modified_superblobs(releases, adds, removes):
+    """Return a dict of modified superblobs keyed by the name of the original.
+
+    Each distinct release is only modified once, however many rules map to it.
+    """
+    return {
+        name: get_modified_superblob(release, adds, removes)
+        for name, release in releases.items()
+    }
+
+
+def get_upload_metadata(xpi):
+    return {SHA512_METADATA_KEY: xpi.sha512sum}
+
+
 def validate_uploaded_xpi_hash(local_xpi, bucket, remote_path):
-    tmpdir = tempfile.mkdtemp()
-    download_path = os.path.join(tmpdir, local_xpi.file_name)
-    bucket.download_file(remote_path, download_path)
-    uploaded_xpi = XPI(download_path)
-    return uploaded_xpi.sha512sum == local_xpi.sha512sum
+    # Loading the object's attributes is a single HEAD request
+    remote_object = bucket.Object(remote_path)
+    if remote_object.content_length != local_xpi.file_size:
+        return False
+
+    sha512 = (remote_object.metadata or {}).get(SHA512_METADATA_KEY)
+    if sha512:
+        return sha512 == local_xpi.sha512sum
+
+    # The ETag of an object uploaded in a single part is usually its MD5
+    # digest, but not when it is encrypted with SSE-KMS or SSE-C
+    if remote_object.e_tag.strip('"') == local_xpi.md5sum:
+        return True
+
+    # No recorded hash and no usable ETag, so stream it through the hasher
+    body = remote_object.get()['Body']
+    digest = Digest(('sha512',))
+    for chunk in iter(lambda: body.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+    return digest.hexdigest('sha512') == local_xpi.sha512sum
@@ -0,0 +1,104 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+
+from morgoth.hashing import Digest
+from morgoth.remote import download
+
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_CONNECTIONS_PER_HOST = 4
+
+
+class HostedFile(object):
+    """A file referenced by a release, and what the release expects it to be."""
+
+    def __init__(self, release, addon_id, url, size, hash_value, hash_function='sha512'):
+        self.releases = [release]
+        self.addon_id = addon_id
+        self.url = url
+        self.size = size
+        self.hash_value = hash_value
+        self.hash_function = hash_function
+
+
+class Verification(object):
+
+    def __init__(self, hosted_file, size=None, hash_value=None, error=None):
+        self.hosted_file = hosted_file
+        self.size = size
+        self.hash_value = hash_value
+        self.error = error
+
+    @property
+    def size_matches(self):
+        return self.size == self.hosted_file.size
+
+    @property
+    def hash_matches(self):
+        return self.hash_value == self.hosted_file.hash_value
+
+    @property
+    def ok(self):
+        return self.error is None and self.size_matches and self.hash_matches
+
+
+def get_hosted_files(releases):
+    """Return the files referenced by the platforms of some releases.
+
+    Files shared by several releases are listed once, with all of them.
+    """
+    hosted_files = {}
+    for release in releases:
+        hash_function = release.get('hashFunction', 'sha512')
+        for addon_id, addon in release.get('addons', {}).items():
+            for platform in addon.get('platforms', {}).values():
+                url = platform.get('fileUrl')
+                if not url:
+                    # Aliases of other platforms
+                    continue
+
+                key = (url, platform.get('filesize'), platform.get('hashValue'), hash_function)
+                if key in hosted_files:
+                    hosted_files[key].releases.append(release['name'])
+                else:
+                    hosted_files[key] = HostedFile(
+                        release['name'], addon_id, url, platform.get('filesize'),
+                        platform.get('hashValue'), hash_function)
+    return list(hosted_files.values())
+
+
+def verify_hosted_file(hosted_file, session):
+    try:
+        digest = download(
+            hosted_file.url, digest=Digest((hosted_file.hash_function,)), session=session)
+    except (RequestException, ValueError) as err:
+        return Verification(hosted_file, error=str(err))
+    return Verification(
+        hosted_file, size=digest.size, hash_value=digest.hexdigest(hosted_file.hash_function))
+
+
+def verify_hosted_files(hosted_files, concurrency=DEFAULT_CONCURRENCY,
+                        connections_per_host=DEFAULT_CONNECTIONS_PER_HOST):
+    """Stream and hash hosted files, yielding a `Verification` as each finishes.
+
+    At most `concurrency` files are fetched at once, and no more than
+    `connections_per_host` of them from any one host.
+    """
+    session = requests.Session()
+    # A blocking pool makes extra requests to a host wait for a free connection
+    adapter = HTTPAdapter(
+        pool_connections=concurrency, pool_maxsize=connections_per_host, pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(verify_hosted_file, hosted_file, session)
+            for hosted_file in hosted_files
+        ]
+        for future in as_completed(futures):
+            yield future.result()
@@ -1,13 +1,18 @@
-import hashlib
 import json
 import os
 import tempfile
 import zipfile
 import requests
-from io import BytesIO
 
 from xml.etree import ElementTree
 
+from morgoth.hashing import digest_file
+from morgoth.remote import RangeFile, RangeRequestsNotSupported, download
+
+
+# Statuses that mean a remote XPI is really missing, rather than that the
+# server won't answer a HEAD or ranged request for it
+MISSING_STATUSES = (404, 410)
 
 PLATFORMS = {
     'Darwin_x86-gcc3': {
@@ -47,7 +52,11 @@ PLATFORMS = {
 
 
 class XPI(object):
-    _hashed = None
+    _digest = None
+    _remote_size = None
+    _cache = None
+    name = None
+    version = None
 
     class DoesNotExist(Exception):
         pass
@@ -58,39 +67,68 @@ class XPI(object):
     class BadXPIfile(Exception):
         pass
 
-    def __init__(self, path):
+    def __init__(self, path, cache=None):
         if path.startswith("https://") or path.startswith("http://"):
-            response = requests.get(path)
-            if response.status_code != 200:
-                raise XPI.DoesNotExist()
             self.archived = True
-            self._stream = BytesIO(response.content)
-            self._xpi_file = tempfile.NamedTemporaryFile()
             self._url = path
-            path = self._xpi_file.name
-            with open(path, "wb") as fh:
-                fh.write(self._stream.getbuffer())
+            self.path = None
+            try:
+                source = RangeFile(path)
+                self._remote_size = source.size
+                self._read_zip(source)
+            except (RangeRequestsNotSupported, requests.ConnectionError, requests.Timeout,
+                    requests.HTTPError) as err:
+                if (isinstance(err, requests.HTTPError)
+                        and err.response.status_code in MISSING_STATUSES):
+                    raise XPI.DoesNotExist()
+                # Some servers reject HEAD requests or only claim to support
+                # ranges, and downloads are retried and resumed, so fetch the
+                # whole file instead
+                self._remote_size = None
+                self._download()
+                self._read_zip(self.path)
         else:
             if not os.path.isfile(path):
                 raise XPI.DoesNotExist()
             self.archived = False
+            self.path = source = path
+
+            if cache:
+                self._cache = cache
+                self._cache_key = cache.get_file_key(path)
+                cached = cache.get(self._cache_key)
+                if cached:
+                    self.name, self.version, self._digest = cached
+                    return
+
+            self._read_zip(source)
+            if self._cache:
+                self._cache.put(self._cache_key, self.name, self.version)
+
+    def _download(self):
+        self._xpi_file = tempfile.NamedTemporaryFile(suffix='.xpi')
+        try:
+            self._digest = download(self._url, self._xpi_file)
+        except requests.HTTPError:
+            raise XPI.DoesNotExist()
+        self.path = self._xpi_file.name
 
-        self.path = path
-
-        tmpdir = tempfile.mkdtemp()
-
+    def _read_zip(self, source):
         try:
-            with zipfile.ZipFile(path, 'r') as zf:
-                zf.extractall(tmpdir)
+            with zipfile.ZipFile(source, 'r') as zf:
+                self._read_metadata(zf)
         except zipfile.BadZipfile:
             raise XPI.BadZipfile()
 
-        rdf_path = os.path.join(tmpdir, 'install.rdf')
-        manifest_path = os.path.join(tmpdir, 'manifest.json')
+    def _read_metadata(self, zf):
+        members = set(zf.namelist())
 
-        if os.path.exists(rdf_path):
-            rdf = ElementTree.parse(rdf_path)
-            description = rdf.getroot()[0]
+        if 'install.rdf' in members:
+            try:
+                rdf = ElementTree.fromstring(zf.read('install.rdf'))
+            except ElementTree.ParseError:
+                raise XPI.BadXPIfile()
+            description = rdf[0]
 
             for child in description:
                 if child.tag.endswith('id'):
@@ -98,17 +136,31 @@ class XPI(object):
 
                 if child.tag.endswith('version'):
                     self.version = child.text
-        elif os.path.exists(manifest_path):
-            with open(manifest_path) as f:
-                manifest = json.loads(f.read())
-                self.name = manifest.get('applications', {}).get('gecko', {}).get('id')
-                self.version = manifest.get('version')
+        elif 'manifest.json' in members:
+            try:
+                manifest = json.loads(zf.read('manifest.json').decode('utf-8'))
+            except ValueError:
+                raise XPI.BadXPIfile()
+            self.name = manifest.get('applications', {}).get('gecko', {}).get('id')
+            self.version = manifest.get('version')
         else:
             raise XPI.BadXPIfile()
 
         if not self.name or not self.version:
             raise XPI.BadXPIfile()
 
+    def validate(self):
+        """Check the CRC of every member without extracting anything."""
+        if self.path is None:
+            self._download()
+
+        try:
+            with zipfile.ZipFile(self.path, 'r') as zf:
+                if zf.testzip() is not None:
+                    raise XPI.BadZipfile()
+        except zipfile.BadZipfile:
+            raise XPI.BadZipfile()
+
     @property
     def release_name(self):
         return '{}-{}'.format(self.name, self.version)
@@ -121,22 +173,40 @@ class XPI(object):
     def file_name(self):
         return '{}-signed.xpi'.format(self.release_name)
 
+    @property
+    def digest(self):
+        if not self._digest:
+            if self.path is None:
+                self._download()
+            else:
+                self._digest = digest_file(self.path)
+                if self._cache:
+                    self._cache.put(self._cache_key, self.name, self.version, self._digest)
+        return self._digest
+
     @property
     def file_size(self):
-        return os.path.getsize(self.path)
+        if not self._digest and self._remote_size is not None:
+            return self._remote_size
+        return self.digest.size
 
     @property
     def sha512sum(self):
-        if not self._hashed:
-            with open(self.path, 'rb') as f:
-                self._hashed = hashlib.sha512(f.read()).hexdigest()
-        return self._hashed
+        return self.digest.hexdigest('sha512')
+
+    @property
+    def sha256sum(self):
+        return self.digest.hexdigest('sha256')
+
+    @property
+    def md5sum(self):
+        return self.digest.hexdigest('md5')
 
     def get_ftp_path(self, prefix, suffix=''):
         return os.path.join(prefix, self.short_name, ''.join([self.file_name[:-4], suffix, '.xpi']))
 
     def generate_release_data(self, base_url='', prefix='', suffix=''):
-        platforms = PLATFORMS
+        platforms = dict(PLATFORMS)
         if self.archived:
             file_url = self._url
         else:
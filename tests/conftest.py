@@ -0,0 +1,261 @@
+import hashlib
+import http.server
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+import pytest
+
+# Keep the caches and config written by the code under test out of the
+# real home directory. This has to happen before morgoth is imported.
+os.environ['HOME'] = tempfile.mkdtemp()
+
+
+RANGE_RE = re.compile(r'bytes=(\d+)-(\d*)')
+
+
+class FileHandler(http.server.BaseHTTPRequestHandler):
+    """Serves `server.files`, misbehaving in the ways `server.mode` asks for.
+
+    Modes are `ranges` (honour Range requests), `ignore-ranges` (advertise
+    them but always answer with the whole file), `wrong-ranges` (answer
+    Range requests with a 206 for a different part of the file) and
+    `no-head` (reject HEAD requests). While
+    `server.drops` is positive, whole file responses are cut off half way.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def send_file_headers(self, status, length, headers=()):
+        self.send_response(status)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(length))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+
+    def do_HEAD(self):
+        data = self.server.files.get(self.path)
+        if self.server.mode == 'no-head':
+            self.send_error(405)
+            return
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_file_headers(200, len(data))
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.headers.get('Range')))
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(server.delay)
+        finally:
+            # Stop counting before the response is sent, or the client could
+            # start its next request before this one is counted out
+            with server.lock:
+                server.in_flight -= 1
+        self.send_file()
+
+    def send_file(self):
+        server = self.server
+        data = server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+
+        match = RANGE_RE.match(self.headers.get('Range', ''))
+        if match and server.mode != 'ignore-ranges':
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(data) - 1
+            if server.mode == 'wrong-ranges':
+                start, end = start + 1, len(data) - 1
+            body = data[start:end + 1]
+            self.send_file_headers(206, len(body), [
+                ('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(data)))])
+            self.wfile.write(body)
+            return
+
+        self.send_file_headers(200, len(data))
+        if server.drops > 0:
+            server.drops -= 1
+            self.wfile.write(data[:len(data) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def file_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FileHandler)
+    server.files = {}
+    server.mode = 'ranges'
+    server.drops = 0
+    server.requests = []
+    server.delay = 0
+    server.lock = threading.Lock()
+    server.in_flight = 0
+    server.max_in_flight = 0
+    server.url = 'http://127.0.0.1:{}'.format(server.server_port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class BalrogHandler(http.server.BaseHTTPRequestHandler):
+    """Just enough of the Balrog admin API for the commands.
+
+    Successful responses have an ETag, and are answered with a 304 when
+    the request already has it.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            self.server.not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 200:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            server.requests.append((method, self.path))
+        try:
+            time.sleep(server.delay)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+        path = self.path.split('?')[0][len('/api/'):]
+        if method == 'GET':
+            self.handle_get(path)
+        else:
+            self.handle_post(path, json.loads(
+                self.rfile.read(int(self.headers['Content-Length']))))
+
+    def handle_get(self, path):
+        server = self.server
+        if path == 'users/current':
+            self.send_json({'username': 'test'})
+        elif path == 'rules':
+            self.send_json({'count': len(server.rules), 'rules': list(server.rules.values())})
+        elif path == 'releases':
+            self.send_json({'releases': [
+                {'name': name, 'product': 'SystemAddons', 'data_version': 1}
+                for name in server.releases
+            ]})
+        elif path == 'scheduled_changes/rules':
+            self.send_json({'count': len(server.scheduled_changes), 'scheduled_changes': [
+                dict(change, sc_id=sc_id, complete=server.enact_changes)
+                for sc_id, change in enumerate(server.scheduled_changes, 1)
+                if sc_id not in server.cancelled_changes
+            ]})
+        elif path.startswith('rules/') and path[len('rules/'):] in server.rules:
+            self.send_json(server.rules[path[len('rules/'):]])
+        elif path.startswith('releases/') and path[len('releases/'):] in server.releases:
+            self.send_json(server.releases[path[len('releases/'):]])
+        else:
+            self.send_json({}, status=404)
+
+    def handle_post(self, path, body):
+        server = self.server
+        if path == 'releases':
+            if body['name'] in server.fail_releases:
+                self.send_json({}, status=500)
+            elif body['name'] in server.releases:
+                self.send_json({'exception': 'Release already exists'}, status=400)
+            else:
+                server.releases[body['name']] = json.loads(body['blob'])
+                self.send_json({'new_data_version': 1}, status=201)
+        elif path == 'scheduled_changes/rules':
+            server.scheduled_changes.append(body)
+            self.send_json({'sc_id': len(server.scheduled_changes)})
+        else:
+            self.send_json({}, status=404)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+
+@pytest.fixture
+def balrog():
+    from morgoth.settings import settings
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), BalrogHandler)
+    server.rules = {}
+    server.releases = {}
+    server.scheduled_changes = []
+    server.enact_changes = False
+    server.cancelled_changes = set()
+    server.fail_releases = set()
+    server.requests = []
+    server.not_modified = 0
+    server.delay = 0
+    server.lock = threading.Lock()
+    server.in_flight = 0
+    server.max_in_flight = 0
+    server.url = 'http://127.0.0.1:{}/'.format(server.server_port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    settings.set('balrog_url', server.url)
+    settings.set('bearer_token', 'test')
+    yield server
+    settings.delete('balrog_url')
+    settings.delete('bearer_token')
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    moto = pytest.importorskip('moto')
+    import boto3
+
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'test')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'test')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        from morgoth.cli import DEFAULT_AWS_BUCKET_NAME
+        bucket = boto3.resource('s3').Bucket(DEFAULT_AWS_BUCKET_NAME)
+        bucket.create()
+        yield bucket
+
+
+def make_xpi(path, addon_id='test@mozilla.org', version='1.0', size=1024):
+    import zipfile
+
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('manifest.json', json.dumps({
+            'applications': {'gecko': {'id': addon_id}},
+            'manifest_version': 2,
+            'name': 'Test',
+            'version': version,
+        }))
+        zf.writestr('data.bin', os.urandom(size))
+    return path
@@ -0,0 +1,104 @@
+import base64
+import json
+import os
+import time
+
+from morgoth.cache import CredentialCache, ResponseCache
+from morgoth.environment import Environment
+
+
+def make_token(expiry):
+    claims = base64.urlsafe_b64encode(json.dumps({'exp': expiry}).encode()).decode()
+    return 'header.{}.signature'.format(claims.rstrip('='))
+
+
+def get_environment(balrog, cache, bearer_token='test'):
+    return Environment(balrog.url, bearer_token=bearer_token, cache=cache)
+
+
+def test_responses_are_revalidated(tmp_path, balrog):
+    balrog.rules = {'1': {'rule_id': 1, 'mapping': 'a'}}
+    environment = get_environment(balrog, ResponseCache(path=str(tmp_path)))
+
+    assert environment.fetch('rules/1') == balrog.rules['1']
+    assert environment.fetch('rules/1') == balrog.rules['1']
+    assert balrog.not_modified == 1
+
+    balrog.rules['1']['mapping'] = 'b'
+    assert environment.fetch('rules/1')['mapping'] == 'b'
+    assert balrog.not_modified == 1
+
+
+def test_writes_invalidate_cached_responses(tmp_path, balrog):
+    balrog.rules = {'1': {'rule_id': 1, 'mapping': 'a'}}
+    balrog.releases = {'a': {'name': 'a'}}
+    cache = ResponseCache(path=str(tmp_path))
+    environment = get_environment(balrog, cache)
+    for endpoint in ('rules', 'rules/1', 'releases/a'):
+        environment.fetch(endpoint)
+
+    # A scheduled change to a rule changes the rules
+    environment.request('scheduled_changes/rules', data={'rule_id': 1, 'mapping': 'b'})
+
+    assert cache.get(environment.get_url('rules'), 'test') is None
+    assert cache.get(environment.get_url('rules/1'), 'test') is None
+    assert cache.get(environment.get_url('releases/a'), 'test') is not None
+
+
+def test_entries_are_kept_per_token(tmp_path, balrog):
+    balrog.releases = {'a': {'name': 'a'}}
+    cache = ResponseCache(path=str(tmp_path))
+
+    get_environment(balrog, cache, bearer_token='one').fetch('releases/a')
+    other = get_environment(balrog, cache, bearer_token='two')
+    assert cache.get(other.get_url('releases/a'), 'two') is None
+    other.fetch('releases/a')
+    assert balrog.not_modified == 0
+
+
+def test_prune_evicts_least_recently_used(tmp_path, balrog):
+    balrog.releases = {name: {'name': name, 'data': 'x' * 1000} for name in 'abcd'}
+    cache = ResponseCache(path=str(tmp_path))
+    environment = get_environment(balrog, cache)
+    for name in 'abc':
+        environment.fetch('releases/{}'.format(name))
+
+    # Make `b` the least recently used
+    for offset, name in enumerate('bac'):
+        url = environment.get_url(f'releases/{name}')
+        meta_path, _ = cache._paths(cache._get_key(url, 'test'))
+        os.utime(meta_path, (time.time() - 100 + offset, time.time() - 100 + offset))
+
+    entry_size = sum(os.path.getsize(path) for path in tmp_path.iterdir()) // 3
+    cache.max_size = entry_size * 3 + entry_size // 2
+    environment.fetch('releases/d')
+
+    cached = {
+        name for name in 'abcd'
+        if cache.get(environment.get_url(f'releases/{name}'), 'test') is not None
+    }
+    assert cached == {'a', 'c', 'd'}
+
+
+def test_credentials_are_remembered_until_they_expire(tmp_path):
+    credentials = CredentialCache(path=str(tmp_path / 'credentials.json'))
+    token = make_token(int(time.time()) + 3600)
+    expiring = make_token(int(time.time()) + 10)
+
+    credentials.add('https://balrog/', token)
+    credentials.add('https://balrog/', expiring)
+    credentials.add('https://balrog/', 'no-expiry')
+
+    assert credentials.is_valid('https://balrog/', token)
+    assert not credentials.is_valid('https://other/', token)
+    assert not credentials.is_valid('https://balrog/', expiring)
+    assert not credentials.is_valid('https://balrog/', 'no-expiry')
+
+
+def test_validated_credentials_are_not_checked_again(balrog):
+    from morgoth.cli import get_validated_environment
+
+    token = make_token(int(time.time()) + 3600)
+    for _ in range(3):
+        get_validated_environment(bearer_token=token)
+    assert balrog.requests == [('GET', '/api/users/current')]
@@ -0,0 +1,103 @@
+import pytest
+
+from click.testing import CliRunner
+
+from conftest import make_xpi
+from morgoth.cli import cli
+from morgoth.s3 import BucketListing
+
+
+@pytest.fixture(autouse=True)
+def working_dir(tmp_path, monkeypatch):
+    # Some commands save release files to the working directory
+    monkeypatch.chdir(tmp_path)
+
+
+def test_make_releases_resumes_an_interrupted_batch(tmp_path, balrog, s3):
+    paths = [
+        make_xpi(str(tmp_path / '{}.xpi'.format(index)),
+                 addon_id='addon{}@mozilla.org'.format(index))
+        for index in range(3)
+    ]
+    balrog.fail_releases = {'addon1@mozilla.org-1.0'}
+
+    result = CliRunner().invoke(
+        cli, ['make', 'releases', '--superblob', '-j', '1'] + paths, input='y\n')
+    assert result.exit_code == 1
+    assert 'addon0@mozilla.org-1.0' in balrog.releases
+
+    balrog.fail_releases = set()
+    result = CliRunner().invoke(
+        cli, ['make', 'releases', '--superblob', '-j', '1'] + paths, input='y\n')
+    assert result.exit_code == 0, result.output
+    assert 'addon0@mozilla.org-1.0: release exists' in result.output
+    assert len(balrog.releases) == 4
+
+    posted = [path for method, path in balrog.requests if method == 'POST']
+    # One failed post and one successful post in the first run, three in the second
+    assert len(posted) == 5
+
+
+@pytest.fixture
+def listing_cache():
+    from morgoth.settings import settings
+
+    settings.set('aws.listing_cache_ttl', '3600')
+    yield
+    settings.delete('aws.listing_cache_ttl')
+
+
+def get_bucket_hashes(bucket):
+    return {
+        obj.key: bucket.Object(obj.key).metadata.get('sha512')
+        for obj in bucket.objects.all()
+    }
+
+
+def test_make_releases_gives_matching_file_names_free_suffixes(tmp_path, balrog, s3):
+    paths = [
+        make_xpi(str(tmp_path / '{}.xpi'.format(index)), addon_id='same@mozilla.org')
+        for index in range(2)
+    ]
+
+    result = CliRunner().invoke(cli, ['make', 'releases', '-j', '1'] + paths, input='y\n')
+    assert result.exit_code == 0, result.output
+
+    hashes = get_bucket_hashes(s3)
+    assert sorted(hashes) == [
+        'pub/system-addons/same/same@mozilla.org-1.0-signed-2.xpi',
+        'pub/system-addons/same/same@mozilla.org-1.0-signed.xpi',
+    ]
+    assert len(set(hashes.values())) == 2
+    assert sorted(balrog.releases) == ['same@mozilla.org-1.0', 'same@mozilla.org-1.0-2']
+
+
+def test_make_releases_adds_uploads_to_the_listing_cache(tmp_path, balrog, s3, listing_cache):
+    path = make_xpi(str(tmp_path / 'a.xpi'), addon_id='cached@mozilla.org')
+    result = CliRunner().invoke(cli, ['make', 'releases', path], input='y\n')
+    assert result.exit_code == 0, result.output
+    uploaded = get_bucket_hashes(s3)
+
+    # Decline to replace the file, then upload the release
+    other_path = make_xpi(str(tmp_path / 'b.xpi'), addon_id='cached@mozilla.org')
+    result = CliRunner().invoke(cli, ['make', 'release', other_path], input='y\nn\ny\n')
+    assert result.exit_code == 0, result.output
+    assert 'XPI with matching filename already uploaded.' in result.output
+
+    hashes = get_bucket_hashes(s3)
+    assert len(hashes) == 2
+    for key, sha512 in uploaded.items():
+        assert hashes[key] == sha512
+
+
+def test_make_release_lists_again_before_writing(tmp_path, balrog, s3, listing_cache):
+    # Cache the listing, then have someone else upload behind its back
+    BucketListing(s3, 'pub/system-addons/stale/', ttl=3600).keys
+    key = 'pub/system-addons/stale/stale@mozilla.org-1.0-signed.xpi'
+    s3.put_object(Key=key, Body=b'not ours', Metadata={'sha512': 'other'})
+
+    path = make_xpi(str(tmp_path / 'a.xpi'), addon_id='stale@mozilla.org')
+    result = CliRunner().invoke(cli, ['make', 'release', path], input='y\nn\ny\n')
+    assert result.exit_code == 0, result.output
+    assert 'XPI with matching filename already uploaded.' in result.output
+    assert s3.Object(key).metadata['sha512'] == 'other'
@@ -0,0 +1,82 @@
+import asyncio
+
+from morgoth.environment import AsyncEnvironment, Environment
+
+
+def superblob(name, blobs):
+    return {'blobs': blobs, 'name': name, 'schema_version': 4000}
+
+
+def release(name):
+    return {'addons': {}, 'name': name, 'schema_version': 5000}
+
+
+def get_requests(balrog, path):
+    return [request for request in balrog.requests if request == ('GET', path)]
+
+
+def test_fetch_rules_fetches_shared_mappings_once(balrog):
+    balrog.releases = {
+        'Superblob-a': superblob('Superblob-a', ['a']),
+        'Superblob-b': superblob('Superblob-b', ['b']),
+    }
+    balrog.rules = {
+        str(rule_id): {'rule_id': rule_id, 'mapping': 'Superblob-a' if rule_id < 4 else 'Superblob-b'}
+        for rule_id in range(5)
+    }
+    rule_ids = sorted(balrog.rules)
+
+    with AsyncEnvironment(Environment(balrog.url, bearer_token='test')) as async_environment:
+        rules, releases = asyncio.run(async_environment.fetch_rules(rule_ids, mappings=True))
+
+    assert rules == balrog.rules
+    assert releases == balrog.releases
+    assert len(get_requests(balrog, '/api/releases/Superblob-a')) == 1
+    assert len(get_requests(balrog, '/api/releases/Superblob-b')) == 1
+
+
+def test_fetch_releases_expands_superblobs(balrog):
+    balrog.releases = {
+        'Superblob-a': superblob('Superblob-a', ['a', 'b']),
+        'Superblob-b': superblob('Superblob-b', ['b', 'c']),
+        'a': release('a'),
+        'b': release('b'),
+        'c': release('c'),
+        'd': release('d'),
+    }
+
+    with AsyncEnvironment(Environment(balrog.url, bearer_token='test')) as async_environment:
+        releases = asyncio.run(async_environment.fetch_releases(
+            ['Superblob-a', 'Superblob-b'], expand=True))
+
+    assert sorted(releases) == ['Superblob-a', 'Superblob-b', 'a', 'b', 'c']
+    assert len(get_requests(balrog, '/api/releases/b')) == 1
+
+
+def test_requests_in_flight_never_exceed_concurrency(balrog):
+    balrog.delay = 0.05
+    balrog.releases = {str(index): release(str(index)) for index in range(20)}
+
+    environment = Environment(balrog.url, bearer_token='test')
+    with AsyncEnvironment(environment, concurrency=3) as async_environment:
+        releases = asyncio.run(async_environment.fetch_releases(list(balrog.releases)))
+
+    assert len(releases) == 20
+    assert balrog.max_in_flight == 3
+
+
+def test_streamed_release_names_are_cached_and_revalidated(tmp_path, balrog):
+    from morgoth.cache import ResponseCache
+    from morgoth.cli import get_release_names
+
+    balrog.releases = {'a': release('a'), 'b': release('b')}
+    environment = Environment(
+        balrog.url, bearer_token='test', cache=ResponseCache(path=str(tmp_path)))
+
+    assert get_release_names(environment) == {'a', 'b'}
+    assert get_release_names(environment) == {'a', 'b'}
+    assert balrog.not_modified == 1
+
+    balrog.releases['c'] = release('c')
+    assert get_release_names(environment) == {'a', 'b', 'c'}
+    assert balrog.not_modified == 1
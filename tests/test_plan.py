@@ -0,0 +1,112 @@
+import pytest
+
+from click.testing import CliRunner
+
+from morgoth.cli import cli
+from morgoth.plan import build_rules_plan
+from morgoth.utils import get_superblob_data
+
+
+def make_release(name):
+    return {'addons': {}, 'name': name, 'schema_version': 5000}
+
+
+def make_rule(rule_id, mapping):
+    return {
+        'rule_id': rule_id,
+        'channel': 'release-sysaddon',
+        'mapping': mapping,
+        'version': '60.0',
+        'data_version': 1,
+    }
+
+
+@pytest.fixture
+def planned(balrog, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    superblob = get_superblob_data(['a'])
+    balrog.releases = {
+        'a': make_release('a'),
+        'b': make_release('b'),
+        superblob['name']: superblob,
+    }
+    balrog.rules = {
+        '1': make_rule(1, superblob['name']),
+        '2': make_rule(2, superblob['name']),
+    }
+
+    result = CliRunner().invoke(cli, ['plan', 'rules', '--add', 'b', '1', '2'])
+    assert result.exit_code == 0, result.output
+    balrog.requests.clear()
+    return get_superblob_data(['a', 'b'])
+
+
+def get_posts(balrog):
+    return [path for method, path in balrog.requests if method == 'POST']
+
+
+def test_build_rules_plan():
+    shared = get_superblob_data(['a'])
+    releases = {shared['name']: shared, 'c': make_release('c')}
+    rules = {
+        '1': make_rule(1, shared['name']),
+        '2': make_rule(2, shared['name']),
+        '3': make_rule(3, 'c'),
+    }
+    release_names = {'a', 'b', 'c', shared['name']}
+
+    plan = build_rules_plan(rules, releases, release_names, ['b'], [], 'https://balrog/')
+
+    expected = [get_superblob_data(['a', 'b']), get_superblob_data(['b', 'c'])]
+    assert plan['releases'] == sorted(expected, key=lambda release: release['name'])
+    assert [(change['rule_id'], change['to']) for change in plan['rule_changes']] == [
+        ('1', expected[0]['name']),
+        ('2', expected[0]['name']),
+        ('3', expected[1]['name']),
+    ]
+    assert plan['rule_changes'][0]['rule']['mapping'] == expected[0]['name']
+
+
+def test_build_rules_plan_reuses_existing_releases():
+    shared = get_superblob_data(['a'])
+    modified = get_superblob_data(['a', 'b'])
+    plan = build_rules_plan(
+        {'1': make_rule(1, shared['name'])}, {shared['name']: shared},
+        {'a', 'b', shared['name'], modified['name']}, ['b'], [], 'https://balrog/')
+    assert plan['releases'] == []
+    assert len(plan['rule_changes']) == 1
+
+
+def test_apply(balrog, planned):
+    result = CliRunner().invoke(cli, ['apply', 'plan.json'], input='y\n')
+    assert result.exit_code == 0, result.output
+    assert balrog.releases[planned['name']] == planned
+    assert [change['mapping'] for change in balrog.scheduled_changes] == [planned['name']] * 2
+    assert get_posts(balrog) == ['/api/releases'] + ['/api/scheduled_changes/rules'] * 2
+
+
+def test_apply_stops_when_a_rule_has_changed(balrog, planned):
+    balrog.rules['2']['data_version'] = 2
+
+    result = CliRunner().invoke(cli, ['apply', 'plan.json'], input='y\n')
+    assert result.exit_code == 1
+    assert 'Rule 2 has changed since the plan was made' in result.output
+    assert get_posts(balrog) == []
+
+
+def test_apply_skips_releases_that_exist(balrog, planned):
+    balrog.releases[planned['name']] = planned
+
+    result = CliRunner().invoke(cli, ['apply', 'plan.json'], input='y\n')
+    assert result.exit_code == 0, result.output
+    assert 'Release exists: {}'.format(planned['name']) in result.output
+    assert get_posts(balrog) == ['/api/scheduled_changes/rules'] * 2
+
+
+def test_apply_stops_when_a_release_differs(balrog, planned):
+    balrog.releases[planned['name']] = dict(planned, blobs=['c'])
+
+    result = CliRunner().invoke(cli, ['apply', 'plan.json'], input='y\n')
+    assert result.exit_code == 1
+    assert 'exists and differs from the plan' in result.output
+    assert get_posts(balrog) == []
@@ -0,0 +1,69 @@
+import time
+
+import pytest
+
+from click.testing import CliRunner
+
+from morgoth import cli
+
+
+@pytest.fixture
+def rules(balrog, monkeypatch):
+    monkeypatch.setattr(cli, 'WAIT_INITIAL_DELAY', 0.01)
+    balrog.rules = {
+        str(rule_id): {
+            'rule_id': rule_id,
+            'channel': 'release-sysaddon' if rule_id else 'release',
+            'mapping': 'Superblob-a',
+            'product': 'SystemAddons',
+        }
+        for rule_id in range(6)
+    }
+    return ['0', '1', '2', '3', '4', '5']
+
+
+def test_promote_rules_in_a_batch(balrog, rules):
+    start = time.monotonic()
+    result = CliRunner().invoke(
+        cli.cli, ['promote', 'rules', '--batch', '--rate', '20'] + rules, input='y\n')
+    elapsed = time.monotonic() - start
+
+    assert result.exit_code == 0, result.output
+    assert 'Rule 0 does not have a `-sysaddon` suffix in the channel.' in result.output
+    assert result.output.count('Promote 5 rules?') == 1
+    assert sorted(change['channel'] for change in balrog.scheduled_changes) == ['release'] * 5
+    # After the first change the rest are spaced out by the rate limit
+    assert elapsed >= 4 / 20
+
+
+def test_promote_rules_rejects_a_rate_of_zero(balrog, rules):
+    result = CliRunner().invoke(
+        cli.cli, ['promote', 'rules', '--batch', '--rate', '0'] + rules, input='y\n')
+    assert result.exit_code == 2
+    assert "Invalid value for '--rate'" in result.output
+    assert balrog.requests == []
+
+
+def test_promote_rules_waits_for_changes(balrog, rules):
+    balrog.enact_changes = True
+    result = CliRunner().invoke(
+        cli.cli, ['promote', 'rules', '--batch', '--wait'] + rules, input='y\n')
+    assert result.exit_code == 0, result.output
+    assert 'All changes enacted' in result.output
+
+
+def test_promote_rules_reports_cancelled_changes(balrog, rules):
+    balrog.enact_changes = True
+    balrog.cancelled_changes = {2}
+    result = CliRunner().invoke(
+        cli.cli, ['promote', 'rules', '--batch', '--wait'] + rules, input='y\n')
+    assert result.exit_code == 1
+    assert 'was not enacted (scheduled change 2).' in result.output
+    assert 'All changes enacted' not in result.output
+
+
+def test_promote_rules_times_out_waiting(balrog, rules):
+    result = CliRunner().invoke(
+        cli.cli, ['promote', 'rules', '--wait', '--timeout', '0', '1'], input='y\n')
+    assert result.exit_code == 1
+    assert 'Rule 1 was not enacted (scheduled change 1).' in result.output
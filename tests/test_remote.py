@@ -0,0 +1,50 @@
+import hashlib
+import io
+import os
+
+import pytest
+
+from morgoth import remote
+from morgoth.remote import download
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(remote, 'MAX_BACKOFF', 0)
+
+
+@pytest.fixture
+def data(file_server):
+    data = os.urandom(3 * 1024 * 1024)
+    file_server.files['/file.xpi'] = data
+    return data
+
+
+@pytest.mark.parametrize('mode', ['ranges', 'ignore-ranges', 'wrong-ranges'])
+def test_download_resumes_or_restarts(file_server, data, mode):
+    file_server.mode = mode
+    file_server.drops = 1
+
+    fileobj = io.BytesIO()
+    digest = download(file_server.url + '/file.xpi', fileobj)
+
+    assert fileobj.getvalue() == data
+    assert digest.size == len(data)
+    assert digest.hexdigest('sha512') == hashlib.sha512(data).hexdigest()
+
+
+def test_download_retries_a_wrong_range_without_a_range(file_server, data):
+    file_server.mode = 'wrong-ranges'
+    file_server.drops = 1
+
+    download(file_server.url + '/file.xpi', io.BytesIO())
+
+    ranges = [requested_range for path, requested_range in file_server.requests]
+    assert ranges[0] is None
+    assert ranges[1] is not None
+    assert ranges[2] is None
+
+
+def test_download_without_a_file_only_hashes(file_server, data):
+    digest = download(file_server.url + '/file.xpi')
+    assert digest.hexdigest('sha512') == hashlib.sha512(data).hexdigest()
@@ -0,0 +1,116 @@
+import os
+import threading
+
+import pytest
+
+from conftest import make_xpi
+from morgoth.s3 import (
+    DEFAULT_MULTIPART_THRESHOLD, BucketListing, MultipartUpload, upload_file)
+from morgoth.utils import get_upload_metadata, validate_uploaded_xpi_hash
+from morgoth.xpi import XPI
+
+
+PREFIX = 'pub/system-addons/test/'
+
+
+def test_cached_listing_is_refreshed(tmp_path, s3):
+    BucketListing(s3, PREFIX, ttl=3600, cache_dir=str(tmp_path)).keys
+    s3.put_object(Key=PREFIX + 'test.xpi', Body=b'xpi')
+
+    listing = BucketListing(s3, PREFIX, ttl=3600, cache_dir=str(tmp_path))
+    assert PREFIX + 'test.xpi' not in listing
+    assert listing.refresh()
+    assert PREFIX + 'test.xpi' in listing
+    assert not listing.refresh()
+
+    # The refreshed listing was cached for the next run
+    assert PREFIX + 'test.xpi' in BucketListing(s3, PREFIX, ttl=3600, cache_dir=str(tmp_path))
+
+
+def test_listing_cache_can_be_saved_from_many_threads(tmp_path, s3):
+    listings = [BucketListing(s3, PREFIX, ttl=3600, cache_dir=str(tmp_path)) for _ in range(8)]
+    for listing in listings:
+        listing.keys
+    errors = []
+
+    def add_keys(listing, index):
+        try:
+            for count in range(50):
+                listing.add('{}{}-{}.xpi'.format(PREFIX, index, count))
+        except Exception as err:
+            errors.append(err)
+
+    threads = [
+        threading.Thread(target=add_keys, args=(listing, index))
+        for index, listing in enumerate(listings)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert list(tmp_path.glob('*.tmp')) == []
+    assert len(BucketListing(s3, PREFIX, ttl=3600, cache_dir=str(tmp_path)).keys) == 50
+
+
+def test_multipart_upload_resumes_after_an_interruption(tmp_path, s3, monkeypatch):
+    chunksize = 5 * 1024 * 1024
+    data = os.urandom(chunksize * 2 + 1024)
+    path = tmp_path / 'test.xpi'
+    path.write_bytes(data)
+    key = PREFIX + 'test.xpi'
+
+    def make_upload():
+        return MultipartUpload(
+            s3, key, str(path), 'hash', metadata={'sha512': 'hash'}, chunksize=chunksize,
+            state_dir=str(tmp_path / 'uploads'))
+
+    client = s3.meta.client
+    upload_part = client.upload_part
+
+    def record_parts(fail_part=None):
+        uploaded = []
+
+        def record_part(**kwargs):
+            if kwargs['PartNumber'] == fail_part:
+                raise ConnectionError('Connection lost')
+            uploaded.append(kwargs['PartNumber'])
+            return upload_part(**kwargs)
+
+        monkeypatch.setattr(client, 'upload_part', record_part)
+        return uploaded
+
+    upload = make_upload()
+    uploaded = record_parts(fail_part=3)
+    with pytest.raises(ConnectionError):
+        upload.upload()
+    assert sorted(uploaded) == [1, 2]
+    assert list(s3.objects.all()) == []
+
+    upload = make_upload()
+    uploaded = record_parts()
+    upload.upload()
+    assert uploaded == [3]
+
+    obj = s3.Object(key)
+    assert obj.get()['Body'].read() == data
+    assert obj.metadata == {'sha512': 'hash'}
+    assert not os.path.exists(upload.state_path)
+
+
+@pytest.mark.parametrize('multipart_threshold', [DEFAULT_MULTIPART_THRESHOLD, 0])
+def test_uploaded_xpis_are_checked_from_their_metadata(tmp_path, s3, multipart_threshold):
+    xpi = XPI(make_xpi(str(tmp_path / 'test.xpi')))
+    key = PREFIX + xpi.file_name
+    upload_file(
+        s3, key, xpi.path, xpi.sha512sum, metadata=get_upload_metadata(xpi),
+        multipart_threshold=multipart_threshold)
+    assert s3.Object(key).metadata == {'sha512': xpi.sha512sum}
+
+    operations = []
+    s3.meta.client.meta.events.register(
+        'before-call.s3', lambda model, **kwargs: operations.append(model.name))
+
+    assert validate_uploaded_xpi_hash(xpi, s3, key)
+    assert operations == ['HeadObject']
@@ -0,0 +1,18 @@
+import requests
+
+from click.testing import CliRunner
+
+from morgoth import cli
+
+
+def test_shell_survives_unexpected_errors(monkeypatch):
+    def get_validated_environment(**kwargs):
+        raise requests.Timeout('Read timed out.')
+
+    monkeypatch.setattr(cli, 'get_validated_environment', get_validated_environment)
+
+    result = CliRunner().invoke(cli.cli, ['shell'], input='verify a\nstats\nexit\n')
+    assert result.exit_code == 0, result.output
+    assert 'Timeout: Read timed out.' in result.output
+    assert 'Round trips saved' in result.output
+    assert cli.session_cache is None
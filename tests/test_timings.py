@@ -0,0 +1,35 @@
+import atexit
+
+from click.testing import CliRunner
+
+from morgoth import cli
+from morgoth.timings import Timings
+
+
+def test_nothing_is_recorded_until_enabled():
+    timings = Timings()
+    with timings.phase('read XPI'):
+        pass
+    timings.record_request('balrog', 0.1, bytes_received=10)
+    assert timings.to_dict() == {'phases': {}, 'requests': {}}
+
+    timings.enabled = True
+    with timings.phase('read XPI'):
+        pass
+    timings.record_request('balrog', 0.1, bytes_received=10)
+    assert timings.phases['read XPI']['count'] == 1
+    assert timings.requests['balrog']['bytes_received'] == 10
+
+
+def test_timings_are_reported_once(monkeypatch):
+    registered = []
+    monkeypatch.setattr(cli, 'timings', Timings())
+    monkeypatch.setattr(atexit, 'register', lambda *args, **kwargs: registered.append(args))
+
+    runner = CliRunner()
+    for _ in range(3):
+        result = runner.invoke(cli.cli, ['--timings', 'config', '--help'])
+        assert result.exit_code == 0, result.output
+
+    assert cli.timings.enabled
+    assert len(registered) == 1
@@ -0,0 +1,97 @@
+import hashlib
+import io
+import json
+
+from morgoth.utils import get_json_member, iter_json_array, validate_uploaded_xpi_hash
+
+
+class FakeXPI(object):
+
+    def __init__(self, data):
+        self.file_size = len(data)
+        self.md5sum = hashlib.md5(data).hexdigest()
+        self.sha512sum = hashlib.sha512(data).hexdigest()
+
+
+class FakeObject(object):
+
+    def __init__(self, data, e_tag, metadata=None):
+        self.data = data
+        self.content_length = len(data)
+        self.e_tag = '"{}"'.format(e_tag)
+        self.metadata = metadata or {}
+        self.gets = 0
+
+    def get(self):
+        self.gets += 1
+        return {'Body': io.BytesIO(self.data)}
+
+
+class FakeBucket(object):
+
+    def __init__(self, remote_object):
+        self.remote_object = remote_object
+
+    def Object(self, remote_path):
+        return self.remote_object
+
+
+def test_validate_uploaded_xpi_hash_with_an_md5_etag():
+    data = b'xpi' * 1000
+    remote_object = FakeObject(data, hashlib.md5(data).hexdigest())
+    assert validate_uploaded_xpi_hash(FakeXPI(data), FakeBucket(remote_object), 'a.xpi')
+    assert remote_object.gets == 0
+
+
+def test_validate_uploaded_xpi_hash_with_an_encrypted_etag():
+    # Objects encrypted with SSE-KMS or SSE-C have ETags that aren't MD5 digests
+    data = b'xpi' * 1000
+    remote_object = FakeObject(data, '0' * 32)
+    assert validate_uploaded_xpi_hash(FakeXPI(data), FakeBucket(remote_object), 'a.xpi')
+    assert remote_object.gets == 1
+
+    other = FakeObject(b'ipx' * 1000, '0' * 32)
+    assert not validate_uploaded_xpi_hash(FakeXPI(data), FakeBucket(other), 'a.xpi')
+
+
+def split(data, size):
+    return [data[index:index + size] for index in range(0, len(data), size)]
+
+
+RELEASES = {
+    'count': 3,
+    'releases': [
+        {'name': 'a', 'data': {'nested': [{'deep': ['x]', '}']}]}},
+        {'name': 'b"]}', 'escaped': 'quote \\" and \\\\ backslash', 'number': 1234567},
+        {'name': 'café ☃', 'product': 'SystemAddons'},
+    ],
+    'after': {'releases': []},
+}
+
+
+def test_iter_json_array_handles_every_chunk_boundary():
+    data = json.dumps(RELEASES, ensure_ascii=False).encode()
+    for size in range(1, len(data) + 1):
+        chunks = iter(split(data, size))
+        assert list(iter_json_array(chunks, 'releases')) == RELEASES['releases'], size
+        # The chunks after the array are still read
+        assert list(chunks) == []
+
+
+def test_iter_json_array_with_an_empty_array():
+    assert list(iter_json_array([b'{"releases"', b': [ ', b'], "count": 0}'], 'releases')) == []
+    assert list(iter_json_array([b'{"count": 0}'], 'releases')) == []
+
+
+def test_get_json_member_handles_every_chunk_boundary():
+    data = json.dumps(RELEASES, ensure_ascii=False).encode()
+    for size in range(1, len(data) + 1):
+        assert get_json_member(split(data, size), 'releases') == RELEASES['releases'], size
+        assert get_json_member(split(data, size), 'after') == {'releases': []}, size
+        assert get_json_member(split(data, size), 'count') == 3, size
+        assert get_json_member(split(data, size), 'missing', 'default') == 'default', size
+
+
+def test_get_json_member_reads_a_number_at_the_end():
+    assert get_json_member([b'{"a": {}, "count": 12', b'34}'], 'count') == 1234
+    assert get_json_member([b'{"a": 1, "count": 1234', b''], 'count') == 1234
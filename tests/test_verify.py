@@ -0,0 +1,100 @@
+import hashlib
+import os
+
+import pytest
+
+from click.testing import CliRunner
+
+from morgoth.cli import cli
+from morgoth.verify import get_hosted_files, verify_hosted_files
+
+
+def make_release(name, url, data, hash_value=None):
+    return {
+        'addons': {
+            name: {
+                'platforms': {
+                    'default': {
+                        'fileUrl': url,
+                        'filesize': len(data),
+                        'hashValue': hash_value or hashlib.sha512(data).hexdigest(),
+                    },
+                    'Linux_x86_64-gcc3': {'alias': 'default'},
+                },
+                'version': '1.0',
+            },
+        },
+        'hashFunction': 'sha512',
+        'name': name,
+        'schema_version': 5000,
+    }
+
+
+def test_verify_hosted_files(file_server):
+    good = os.urandom(100 * 1024)
+    bad = os.urandom(100 * 1024)
+    file_server.files = {'/good.xpi': good, '/bad.xpi': bad}
+
+    hosted_files = get_hosted_files([
+        make_release('good', file_server.url + '/good.xpi', good),
+        make_release('also-good', file_server.url + '/good.xpi', good),
+        make_release('bad', file_server.url + '/bad.xpi', bad, hash_value='0' * 128),
+        make_release('missing', file_server.url + '/missing.xpi', b''),
+    ])
+    assert len(hosted_files) == 3
+
+    results = {
+        verification.hosted_file.url.rsplit('/', 1)[1]: verification
+        for verification in verify_hosted_files(hosted_files)
+    }
+
+    assert results['good.xpi'].ok
+    assert results['good.xpi'].hosted_file.releases == ['good', 'also-good']
+    assert not results['bad.xpi'].ok
+    assert results['bad.xpi'].size_matches
+    assert not results['bad.xpi'].hash_matches
+    assert results['missing.xpi'].error
+    # Each file was only fetched once
+    assert len(file_server.requests) == 3
+
+
+def test_verify_limits_connections_per_host(file_server):
+    file_server.delay = 0.05
+    data = os.urandom(1024)
+    file_server.files = {'/{}.xpi'.format(index): data for index in range(12)}
+
+    hosted_files = get_hosted_files([
+        make_release(str(index), file_server.url + '/{}.xpi'.format(index), data)
+        for index in range(12)
+    ])
+    verifications = list(verify_hosted_files(
+        hosted_files, concurrency=6, connections_per_host=2))
+
+    assert all(verification.ok for verification in verifications)
+    assert file_server.max_in_flight == 2
+
+
+def test_verify_command(balrog, file_server):
+    data = os.urandom(1024)
+    file_server.files = {'/a.xpi': data}
+    balrog.releases = {
+        'a': make_release('a', file_server.url + '/a.xpi', data),
+        'Superblob-a': {'blobs': ['a'], 'name': 'Superblob-a', 'schema_version': 4000},
+    }
+
+    result = CliRunner().invoke(cli, ['verify', 'Superblob-a'])
+    assert result.exit_code == 0, result.output
+    assert 'OK: {}/a.xpi'.format(file_server.url) in result.output
+
+
+@pytest.mark.parametrize('release_name', ['missing', 'Superblob-a'])
+def test_verify_command_with_a_missing_release(balrog, release_name):
+    balrog.releases = {
+        'Superblob-a': {'blobs': ['missing'], 'name': 'Superblob-a', 'schema_version': 4000},
+    }
+
+    result = CliRunner().invoke(cli, ['verify', '-v', release_name])
+    assert result.exit_code == 1
+    assert isinstance(result.exception, SystemExit)
+    assert 'Unable to fetch release missing' in result.output
+    assert 'HTTP 404' in result.output
@@ -0,0 +1,53 @@
+import hashlib
+
+import pytest
+
+from conftest import make_xpi
+from morgoth.xpi import XPI
+
+
+@pytest.fixture
+def remote_xpi(tmp_path, file_server):
+    path = make_xpi(str(tmp_path / 'test.xpi'), size=512 * 1024)
+    with open(path, 'rb') as f:
+        data = f.read()
+    file_server.files['/test.xpi'] = data
+    return file_server.url + '/test.xpi', data
+
+
+def test_remote_xpi_is_read_with_ranges(file_server, remote_xpi):
+    url, data = remote_xpi
+    xpi = XPI(url)
+
+    assert (xpi.name, xpi.version) == ('test@mozilla.org', '1.0')
+    assert xpi.file_size == len(data)
+    assert file_server.requests
+    assert all(requested_range for path, requested_range in file_server.requests)
+
+    assert xpi.sha512sum == hashlib.sha512(data).hexdigest()
+
+
+def test_remote_xpi_is_downloaded_when_ranges_are_ignored(file_server, remote_xpi):
+    url, data = remote_xpi
+    file_server.mode = 'ignore-ranges'
+    xpi = XPI(url)
+
+    assert (xpi.name, xpi.version) == ('test@mozilla.org', '1.0')
+    assert xpi.file_size == len(data)
+    assert xpi.sha512sum == hashlib.sha512(data).hexdigest()
+    # The whole file was downloaded after the ranged read failed
+    assert ('/test.xpi', None) in file_server.requests
+
+
+def test_missing_remote_xpi(file_server):
+    with pytest.raises(XPI.DoesNotExist):
+        XPI(file_server.url + '/missing.xpi')
+
+
+def test_remote_xpi_is_downloaded_when_head_is_rejected(file_server, remote_xpi):
+    url, data = remote_xpi
+    file_server.mode = 'no-head'
+    xpi = XPI(url)
+
+    assert (xpi.name, xpi.version) == ('test@mozilla.org', '1.0')
+    assert xpi.sha512sum == hashlib.sha512(data).hexdigest()